@@ -0,0 +1,250 @@
+from __future__ import division
+import argparse
+import cPickle
+import json
+import multiprocessing
+import numpy as np
+import os
+import Queue
+import resource
+import shutil
+import tempfile
+import time
+from index_cache import UNK_TOKEN
+
+
+def generate_corpus(n_examples=10000, vocab_size=20000, group_size=10, seed=42):
+    """
+    Synthetic Ubuntu-like corpus: Zipf-distributed words, multi-turn contexts
+    separated by __eot__, and groups of one true and group_size-1 false
+    responses. Returns the dataset as text, its word_idx_map and a random W.
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array(['w%d' % i for i in xrange(vocab_size)] + ['sudo', 'apt-get', ':)', 'http://ubuntu.com', '12:30'])
+    def sentence(n):
+        return ' '.join(words[np.minimum(rng.zipf(1.3, n), len(words)) - 1])
+    def context():
+        return ' __eot__ '.join(sentence(rng.randint(2, 25)) for _ in xrange(rng.randint(1, 8)))
+    common = [sentence(rng.randint(1, 3)) for _ in xrange(50)]
+    def response():
+        # some responses ("thanks", "ok") repeat a lot, as in the real corpus
+        return common[rng.randint(len(common))] if rng.rand() < 0.2 else sentence(rng.randint(1, 30))
+    data = { 'c': [], 'r': [], 'y': [] }
+    for i in xrange(n_examples // group_size):
+        c = context()
+        for j in xrange(group_size):
+            data['c'].append(c)
+            data['r'].append(response())
+            data['y'].append(1 if j == 0 else 0)
+    word_idx_map = dict((w, i+1) for i, w in enumerate(list(words) + ['__eot__', UNK_TOKEN]))
+    W = rng.uniform(-0.25, 0.25, (len(word_idx_map)+1, 300)).astype(np.float32)
+    return data, word_idx_map, W
+
+def index_corpus(data, word_idx_map):
+    from index_cache import IndexCache
+    cache = IndexCache(word_idx_map, UNK_TOKEN)
+    return dict((k, [cache(s) for s in data[k]]) if k != 'y' else (k, list(data[k])) for k in data)
+
+def bench_tokenize(data, word_idx_map, W, args):
+    from twokenize import tokenize
+    sents = data['c'] + data['r']
+    start_time = time.time()
+    for s in sents:
+        tokenize(s)
+    return len(sents), time.time() - start_time
+
+def bench_get_idx_from_sent(data, word_idx_map, W, args):
+    from merge_data import get_idx_from_sent
+    sents = data['c'] + data['r']
+    start_time = time.time()
+    for s in sents:
+        get_idx_from_sent(s, word_idx_map, 300)
+    return len(sents), time.time() - start_time
+
+def bench_index_cache(data, word_idx_map, W, args):
+    from index_cache import IndexCache
+    sents = data['c'] + data['r']
+    cache = IndexCache(word_idx_map, UNK_TOKEN)
+    start_time = time.time()
+    for s in sents:
+        cache(s)
+    return len(sents), time.time() - start_time
+
+def bench_load_W(data, word_idx_map, W, args):
+    from common import load_W
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cPickle.dump([W, word_idx_map], open('%s/W.pkl' % tmpdir, 'wb'), protocol=-1)
+        np.save('%s/W.npy' % tmpdir, W)
+        start_time = time.time()
+        for fname in ['W.pkl', 'W.npy']:
+            np.asarray(load_W('%s/%s' % (tmpdir, fname))).sum()
+        return 2 * W.nbytes, time.time() - start_time
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_load_dataset(data, word_idx_map, W, args):
+    """
+    Full loading path of main.py, dataset plus W, from the pickles and from a
+    packed_data.py directory; the packed arrays are read through once so the
+    memory-mapped path does the same I/O.
+    """
+    from common import load_W
+    import packed_data
+    idx_data = index_corpus(data, word_idx_map)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cPickle.dump([idx_data, idx_data, idx_data], open('%s/dataset.pkl' % tmpdir, 'wb'), protocol=-1)
+        cPickle.dump([W, word_idx_map], open('%s/W.pkl' % tmpdir, 'wb'), protocol=-1)
+        packed_data.pack_dataset([idx_data, dict(idx_data), dict(idx_data)], '%s/packed' % tmpdir, W.shape[0])
+        np.save('%s/packed/W.npy' % tmpdir, W)
+        start_time = time.time()
+        cPickle.load(open('%s/dataset.pkl' % tmpdir, 'rb'))
+        np.asarray(load_W('%s/W.pkl' % tmpdir)).sum()
+        for dataset in packed_data.load_packed('%s/packed' % tmpdir):
+            for key in ['c', 'r']:
+                seqs = dataset[key].seqs if isinstance(dataset[key], packed_data.GroupedSequences) else dataset[key]
+                np.asarray(seqs.tokens).sum()
+            np.asarray(dataset['y']).sum()
+        np.asarray(load_W('%s/packed/W.npy' % tmpdir)).sum()
+        return 2 * 3 * len(idx_data['y']), time.time() - start_time
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_tfidf(data, word_idx_map, W, args):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    import tfidf
+    vectorizer = TfidfVectorizer()
+    vectorizer.fit(data['c'] + data['r'])
+    C_vec = vectorizer.transform(data['c'])
+    R_vec = vectorizer.transform(data['r'])
+    start_time = time.time()
+    tfidf.run(C_vec, R_vec, np.array(data['y']), 10)
+    return len(data['y']), time.time() - start_time
+
+def build_model(data, W, args, encoder):
+    from main import Model
+    idx_data = index_corpus(data, args.word_idx_map)
+    return Model(data={ 'train': idx_data, 'val': idx_data, 'test': idx_data }, W=W,
+                 max_seqlen=args.max_seqlen, hidden_size=args.hidden_size,
+                 batch_size=args.batch_size, encoder=encoder)
+
+def bench_set_shared_variables(data, word_idx_map, W, args):
+    model = build_model(data, W, args, 'rnn')
+    n_batches = len(data['y']) // args.batch_size
+    start_time = time.time()
+    for i in xrange(n_batches):
+        model.set_shared_variables(model.data['train'], i)
+    return n_batches * args.batch_size, time.time() - start_time
+
+def bench_recall(data, word_idx_map, W, args):
+    from common import compute_recall_ks
+    probas = np.random.RandomState(42).rand(len(data['y']))
+    start_time = time.time()
+    compute_recall_ks(probas)
+    return len(probas), time.time() - start_time
+
+def make_train_step_bench(encoder):
+    def bench(data, word_idx_map, W, args):
+        model = build_model(data, W, args, encoder)
+        n_batches = min(args.n_train_steps, len(data['y']) // args.batch_size)
+        model.set_shared_variables(model.data['train'], 0)
+        model.train_model()
+        start_time = time.time()
+        for i in xrange(n_batches):
+            model.set_shared_variables(model.data['train'], i)
+            model.train_model()
+            model.set_zero(model.zero_vec)
+        return n_batches * args.batch_size, time.time() - start_time
+    return bench
+
+BENCHMARKS = [
+    ('tokenize', bench_tokenize),
+    ('get_idx_from_sent', bench_get_idx_from_sent),
+    ('index_cache', bench_index_cache),
+    ('load_W', bench_load_W),
+    ('load_dataset', bench_load_dataset),
+    ('tfidf_run', bench_tfidf),
+    ('recall_ks', bench_recall),
+    ('set_shared_variables', bench_set_shared_variables),
+    ('train_step_rnn', make_train_step_bench('rnn')),
+    ('train_step_lstm', make_train_step_bench('lstm')),
+    ('train_step_gru', make_train_step_bench('gru')),
+]
+
+def run_isolated(fn, data, word_idx_map, W, args, queue):
+    try:
+        n_items, elapsed = fn(data, word_idx_map, W, args)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({ 'items_per_s': n_items / max(elapsed, 1e-9), 'time_s': elapsed, 'peak_rss_kb': peak_rss })
+    except ImportError as e:
+        queue.put({ 'skipped': str(e) })
+    except Exception as e:
+        queue.put({ 'error': '%s: %s' % (type(e).__name__, e) })
+
+def run_benchmarks(names, data, word_idx_map, W, args):
+    """
+    Runs each benchmark in its own process so peak memory is measured per
+    benchmark, and missing optional dependencies only skip that benchmark.
+    """
+    results = {}
+    for name, fn in BENCHMARKS:
+        if names and name not in names:
+            continue
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_isolated, args=(fn, data, word_idx_map, W, args, queue))
+        p.start()
+        p.join()
+        try:
+            results[name] = queue.get(timeout=1)
+        except Queue.Empty:
+            results[name] = { 'error': 'exit code %s' % p.exitcode }
+        print name, results[name]
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the throughput of every benchmark relative to the baseline and
+    returns the names of those that regressed by more than tolerance.
+    """
+    regressions = []
+    for name in sorted(results):
+        if 'items_per_s' not in results[name] or 'items_per_s' not in baseline.get(name, {}):
+            continue
+        ratio = results[name]['items_per_s'] / baseline[name]['items_per_s']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print '%-24s %8.2fx throughput, peak rss %d -> %d kB%s' % (
+            name, ratio, baseline[name].get('peak_rss_kb', 0), results[name]['peak_rss_kb'], flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, default='', help='Comma-separated benchmarks to run (all if empty)')
+    parser.add_argument('--n_examples', type=int, default=10000, help='Num synthetic examples')
+    parser.add_argument('--vocab_size', type=int, default=20000, help='Synthetic vocabulary size')
+    parser.add_argument('--batch_size', type=int, default=256, help='Batch size')
+    parser.add_argument('--hidden_size', type=int, default=50, help='Hidden size')
+    parser.add_argument('--max_seqlen', type=int, default=160, help='Max seqlen')
+    parser.add_argument('--n_train_steps', type=int, default=10, help='Num timed train_model steps per encoder')
+    parser.add_argument('--baseline_fname', type=str, default='', help='Baseline JSON to compare against')
+    parser.add_argument('--save_fname', type=str, default='', help='Write results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative throughput drop')
+    args = parser.parse_args()
+
+    data, word_idx_map, W = generate_corpus(args.n_examples, args.vocab_size)
+    args.word_idx_map = word_idx_map
+    names = [n for n in args.benchmarks.split(',') if n]
+    results = run_benchmarks(names, data, word_idx_map, W, args)
+
+    if args.save_fname:
+        json.dump(results, open(args.save_fname, 'wb'), indent=2, sort_keys=True)
+    if args.baseline_fname and os.path.exists(args.baseline_fname):
+        regressions = compare(results, json.load(open(args.baseline_fname)), args.tolerance)
+        if regressions:
+            print 'regressions:', ', '.join(regressions)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+NumPy-only helpers shared by main.py and the scripts that must run without
+Theano: recall@k of grouped probabilities and loading W and its word index.
+"""
+from __future__ import division
+import cPickle
+import numpy as np
+import os
+
+def compute_recall_ks(probas):
+  recall_k = {}
+  for group_size in [2, 5, 10]:
+      recall_k[group_size] = {}
+      print 'group_size: %d' % group_size
+      for k in [1, 2, 5]:
+          if k < group_size:
+              recall_k[group_size][k] = recall(probas, k, group_size)
+              print 'recall@%d' % k, recall_k[group_size][k]
+  return recall_k
+
+def recall(probas, k, group_size):
+    test_size = 10
+    n_batches = len(probas) // test_size
+    n_correct = 0
+    for i in xrange(n_batches):
+        batch = np.array(probas[i*test_size:(i+1)*test_size])[:group_size]
+        #p = np.random.permutation(len(batch))
+        #indices = p[np.argpartition(batch[p], -k)[-k:]]
+        indices = np.argpartition(batch, -k)[-k:]
+        if 0 in indices:
+            n_correct += 1
+    return n_correct / (len(probas) / test_size)
+
+def flatten_recall_ks(recall_k, prefix):
+    """
+    Turns {group_size: {k: recall}} into {'<prefix>_r<k>@<group_size>': recall}.
+    """
+    return dict(('%s_r%d@%d' % (prefix, k, group_size), float(v))
+                for group_size in recall_k for k, v in recall_k[group_size].iteritems())
+
+def load_W(fname):
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r')
+    W, _ = cPickle.load(open(fname, 'rb'))
+    return W
+
+def word_idx_map_fname(W_fname):
+    """
+    Where the word_idx_map of an .npy W is pickled: <name>_word_idx_map.pkl
+    for <name>.npy, as w2v.py writes it.
+    """
+    return W_fname[:-len('.npy')] + '_word_idx_map.pkl'
+
+def load_word_idx_map(fname):
+    """
+    word_idx_map matching load_W(fname): for an .npy matrix, the map pickled
+    by w2v.py next to it, or else the word_idx_map.pkl of the packed_data.py
+    or shard directory holding it; for a pickled [W, word_idx_map], its
+    second item. fname may also be such a directory.
+    """
+    if os.path.isdir(fname):
+        return cPickle.load(open('%s/word_idx_map.pkl' % fname, 'rb'))
+    if fname.endswith('.npy'):
+        if os.path.exists(word_idx_map_fname(fname)):
+            return cPickle.load(open(word_idx_map_fname(fname), 'rb'))
+        return cPickle.load(open('%s/word_idx_map.pkl' % (os.path.dirname(fname) or '.'), 'rb'))
+    _, word_idx_map = cPickle.load(open(fname, 'rb'))
+    return word_idx_map
@@ -0,0 +1,162 @@
+from __future__ import division
+import multiprocessing
+import numpy as np
+import os
+import pyprind
+import Queue
+import traceback
+
+class Barrier:
+    """
+    Reusable barrier for n processes (multiprocessing has none in Python 2).
+    """
+    def __init__(self, n):
+        self.n = n
+        self.count = multiprocessing.Value('i', 0, lock=False)
+        self.mutex = multiprocessing.Lock()
+        self.turnstile = multiprocessing.Semaphore(0)
+        self.turnstile2 = multiprocessing.Semaphore(1)
+
+    def wait(self):
+        with self.mutex:
+            self.count.value += 1
+            if self.count.value == self.n:
+                self.turnstile2.acquire()
+                self.turnstile.release()
+        self.turnstile.acquire()
+        self.turnstile.release()
+        with self.mutex:
+            self.count.value -= 1
+            if self.count.value == 0:
+                self.turnstile.acquire()
+                self.turnstile2.release()
+        self.turnstile2.acquire()
+        self.turnstile2.release()
+
+def shared_array(shape, dtype):
+    typecode = 'd' if np.dtype(dtype) == np.float64 else 'f'
+    size = int(np.prod(shape))
+    return np.frombuffer(multiprocessing.RawArray(typecode, size), dtype=np.dtype(dtype)).reshape(shape)
+
+def get_state(state_vars, out):
+    offset = 0
+    for v in state_vars:
+        value = v.get_value(borrow=True)
+        out[offset:offset+value.size] = value.ravel()
+        offset += value.size
+
+def set_state(state_vars, flat):
+    offset = 0
+    for v in state_vars:
+        value = v.get_value(borrow=True)
+        v.set_value(flat[offset:offset+value.size].reshape(value.shape).astype(value.dtype))
+        offset += value.size
+
+class StateAverager:
+    """
+    Averages parameters and optimizer state of n_workers replicas through
+    shared memory: every worker writes its state to its own row, each worker
+    then averages one slice of the columns, and all read the result back.
+    """
+    def __init__(self, state_vars, n_workers):
+        self.state_vars = state_vars
+        self.n_workers = n_workers
+        total = sum(v.get_value(borrow=True).size for v in state_vars)
+        dtype = state_vars[0].get_value(borrow=True).dtype
+        self.slots = shared_array((n_workers, total), dtype)
+        self.avg = shared_array((total,), dtype)
+        self.bounds = np.linspace(0, total, n_workers+1).astype(np.int64)
+        self.barrier = Barrier(n_workers)
+
+    def sync(self, rank):
+        get_state(self.state_vars, self.slots[rank])
+        self.barrier.wait()
+        lo, hi = self.bounds[rank], self.bounds[rank+1]
+        self.avg[lo:hi] = self.slots[:, lo:hi].mean(axis=0)
+        self.barrier.wait()
+        set_state(self.state_vars, self.avg)
+
+def worker(model, rank, tasks, done, averager, sync_every):
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                os._exit(0)
+            shard, sync_until = task
+            # start from the parent's state, published in averager.avg
+            set_state(model.updated_vars, averager.avg)
+            bar = pyprind.ProgBar(len(shard), monitor=True) if rank == 0 else None
+            cost = model.train_steps(shard, bar, lambda: averager.sync(rank), sync_every, sync_until)
+            done.put((rank, cost))
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+
+class DataParallelTrainer:
+    """
+    Trains model with n_workers forked replicas, created once and reused for
+    every call to run(). Each global step, worker k takes the k-th of
+    n_workers consecutive minibatches; when the count does not divide evenly
+    the first workers take one extra. The replicas' parameters and optimizer
+    state (Adam's m, v and t included) are averaged every sync_every steps
+    and after the last one.
+
+    Every sync moves all of that state, about three times the size of the
+    parameters with Adam, through shared memory and two barriers, so a
+    sync_every of tens of steps is needed for the workers to run ahead of it.
+    Replicas drift further apart between syncs as sync_every grows.
+    """
+    def __init__(self, model, n_workers, sync_every=50):
+        self.model = model
+        self.n_workers = n_workers
+        self.sync_every = sync_every
+        self.state_vars = model.updated_vars
+        self.averager = StateAverager(self.state_vars, n_workers)
+        self.tasks = [multiprocessing.Queue() for _ in xrange(n_workers)]
+        self.done = multiprocessing.Queue()
+        self.procs = [multiprocessing.Process(target=worker, args=(model, k, self.tasks[k], self.done, self.averager, sync_every))
+                      for k in xrange(n_workers)]
+        for p in self.procs:
+            p.start()
+
+    def check_workers(self):
+        for p in self.procs:
+            if p.exitcode is not None:
+                self.terminate()
+                raise RuntimeError('data-parallel worker exited with code %d' % p.exitcode)
+
+    def run(self, indices):
+        """
+        Trains on the minibatch indices and loads the averaged state back into
+        model. Returns the summed cost and the number of minibatches.
+        """
+        model = self.model
+        if len(indices) < self.n_workers:
+            return model.train_steps(indices), len(indices)
+        shards = [indices[k::self.n_workers] for k in xrange(self.n_workers)]
+        get_state(self.state_vars, self.averager.avg)
+        for k in xrange(self.n_workers):
+            self.tasks[k].put((shards[k], len(shards[-1])))
+        total_cost = 0
+        for _ in xrange(self.n_workers):
+            while True:
+                try:
+                    rank, cost = self.done.get(timeout=0.5)
+                    break
+                except Queue.Empty:
+                    self.check_workers()
+            total_cost += cost
+        set_state(self.state_vars, self.averager.avg)
+        model.set_zero(model.zero_vec)
+        return total_cost, len(indices)
+
+    def terminate(self):
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+
+    def close(self):
+        for q in self.tasks:
+            q.put(None)
+        for p in self.procs:
+            p.join()
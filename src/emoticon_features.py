@@ -0,0 +1,130 @@
+"""
+Per-utterance emoticon flags for dialogue datasets, as compact uint8 bit
+fields, using the patterns of emoticons.py combined into a single regex.
+"""
+import argparse
+import cPickle
+import csv
+import multiprocessing
+import numpy as np
+import re
+import emoticons
+import packed_data
+
+FLAGS = ['happy', 'sad', 'wink', 'tongue', 'other']
+BITS = dict((name, 1 << i) for i, name in enumerate(FLAGS))
+
+Nose = r'(?:|o|O|-)'
+Eyes = '(?:%s|%s)' % (emoticons.NormalEyes, emoticons.Wink)
+
+# alternatives are tried in this order at each position, so e.g. ':o)' is
+# happy rather than 'other' followed by ')'
+Combined_RE = emoticons.mycompile('|'.join([
+    r'(?P<happy>\^_\^|%s%s%s)' % (emoticons.NormalEyes, Nose, emoticons.HappyMouths),
+    r'(?P<sad>%s%s%s)' % (emoticons.NormalEyes, Nose, emoticons.SadMouths),
+    r'(?P<wink>%s%s%s)' % (emoticons.Wink, Nose, emoticons.HappyMouths),
+    r'(?P<tongue>%s%s%s)' % (emoticons.NormalEyes, Nose, emoticons.Tongue),
+    r'(?P<other>%s%s%s)' % (Eyes, Nose, emoticons.OtherMouths)
+]))
+
+def extract_flags(text):
+    """
+    Bit field of the emoticon kinds found in text, in one scan.
+    """
+    flags = 0
+    for m in Combined_RE.finditer(text):
+        flags |= BITS[m.lastgroup]
+    return flags
+
+def analyze(text):
+    """
+    Same labels as emoticons.analyze_tweet, derived from extract_flags.
+    """
+    flags = extract_flags(text)
+    h, s = flags & BITS['happy'], flags & BITS['sad']
+    if h and s: return 'BOTH_HS'
+    if h: return 'HAPPY'
+    if s: return 'SAD'
+    return 'NA'
+
+def extract_rows(rows):
+    return np.array([[extract_flags(c), extract_flags(r)] for c, r in rows], dtype=np.uint8).reshape((-1, 2))
+
+def read_csv_chunks(fname, chunk_size):
+    chunk = []
+    for line in csv.reader(open(fname, 'rb')):
+        chunk.append((line[0].decode('utf-8', 'replace'), line[1].decode('utf-8', 'replace')))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_features(fname, n_workers=1, chunk_size=10000):
+    """
+    (n_rows, 2) uint8 flags of the context and response of every CSV row,
+    computed in chunks by n_workers processes.
+    """
+    chunks = read_csv_chunks(fname, chunk_size)
+    if n_workers == 1:
+        return np.concatenate([extract_rows(c) for c in chunks])
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        return np.concatenate(list(pool.imap(extract_rows, chunks)))
+    finally:
+        pool.close()
+        pool.join()
+
+def word_flags(word_idx_map):
+    """
+    Flags of every vocabulary entry, indexed by word id. twokenize keeps
+    emoticons as single tokens, so a sequence's flags are the OR of these.
+    """
+    flags = np.zeros(max(word_idx_map.itervalues())+1, dtype=np.uint8)
+    for w, i in word_idx_map.iteritems():
+        flags[i] = extract_flags(w.decode('utf-8') if isinstance(w, str) else w)
+    return flags
+
+def packed_flags(seqs, flags):
+    """
+    OR of the token flags of every sequence of a PackedSequences or
+    GroupedSequences.
+    """
+    if isinstance(seqs, packed_data.GroupedSequences):
+        return packed_flags(seqs.seqs, flags)[np.asarray(seqs.ids)]
+    offsets = np.asarray(seqs.offsets)
+    out = np.zeros(len(seqs), dtype=np.uint8)
+    # reduceat gives an empty sequence the flags of the token at its offset,
+    # and cannot take an offset past the last token, so skip empty ones
+    nz = offsets[1:] > offsets[:-1]
+    if nz.any():
+        out[nz] = np.bitwise_or.reduceat(flags[np.asarray(seqs.tokens)], offsets[:-1][nz])
+    return out
+
+def packed_features(in_dir, split):
+    word_idx_map = cPickle.load(open('%s/word_idx_map.pkl' % in_dir, 'rb'))
+    flags = word_flags(word_idx_map)
+    dataset = packed_data.load_packed(in_dir)[packed_data.SPLITS.index(split)]
+    return np.column_stack([packed_flags(dataset['c'], flags), packed_flags(dataset['r'], flags)])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv_fname', type=str, default='', help='Raw context,response,label CSV')
+    parser.add_argument('--packed_dir', type=str, default='', help='Directory written by packed_data.py (used if no CSV is given)')
+    parser.add_argument('--split', type=str, default='train', help='Split of the packed dataset')
+    parser.add_argument('--output_fname', type=str, default='emoticon_features.npy', help='Output (n_rows, 2) uint8 array')
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count(), help='Num processes for CSV input')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Rows per chunk for CSV input')
+    args = parser.parse_args()
+
+    if args.csv_fname:
+        features = csv_features(args.csv_fname, args.n_workers, args.chunk_size)
+    else:
+        features = packed_features(args.packed_dir, args.split)
+    np.save(args.output_fname, features)
+    print 'rows: %d, columns: context, response, bits: %s' % (len(features), ', '.join(FLAGS))
+    for j, name in enumerate(['context', 'response']):
+        print name, ', '.join('%s %.4f' % (f, np.mean(features[:, j] & BITS[f] > 0)) for f in FLAGS)
+
+if __name__ == '__main__':
+    main()
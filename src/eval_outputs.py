@@ -0,0 +1,39 @@
+import numpy as np
+import os
+
+KEYS = ['probas', 'y', 'group_ids']
+
+def output_fnames(prefix, suffix=''):
+    return dict((key, '%s_%s%s.npy' % (prefix, key, suffix)) for key in KEYS)
+
+class ProbaWriter:
+    """
+    Preallocated .npy memmaps of the probabilities, labels and group ids of
+    the rows scored by one evaluation, with probabilities filled in batch by
+    batch. Files are written under a temporary name and renamed by close(),
+    so the outputs of the last complete evaluation survive a crash.
+    """
+    def __init__(self, prefix, y, group_ids):
+        self.prefix = prefix
+        self.tmp_fnames = output_fnames(prefix, '.partial')
+        n = len(y)
+        assert len(group_ids) == n
+        self.probas = np.lib.format.open_memmap(self.tmp_fnames['probas'], mode='w+', dtype=np.float32, shape=(n,))
+        np.save(self.tmp_fnames['y'], np.asarray(y, dtype=np.int8))
+        np.save(self.tmp_fnames['group_ids'], np.asarray(group_ids, dtype=np.int32))
+
+    def write(self, start, probas):
+        self.probas[start:start+len(probas)] = probas
+
+    def close(self):
+        self.probas.flush()
+        del self.probas
+        for key, fname in output_fnames(self.prefix).iteritems():
+            os.rename(self.tmp_fnames[key], fname)
+        return load_outputs(self.prefix)['probas']
+
+def load_outputs(prefix, mmap_mode='r'):
+    """
+    Memory-mapped probas, y and group_ids written by ProbaWriter.
+    """
+    return dict((key, np.load(fname, mmap_mode=mmap_mode)) for key, fname in output_fnames(prefix).iteritems())
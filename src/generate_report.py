@@ -1,59 +1,127 @@
 from __future__ import division
+import argparse
 import cPickle
-import itertools
 import numpy as np
+import os
+import packed_data
+from common import load_word_idx_map
 
-_, _, test_data = cPickle.load(open('dataset_ibm/blobs/dataset.pkl'))
-test_probas = cPickle.load(open('test_probas.pkl'))
-print test_probas.shape
-W, word_idx_map = cPickle.load(open('dataset_ibm/blobs/W.pkl'))
+def build_inv_vocab(word_idx_map):
+    """
+    Array-backed inverse vocabulary: inv_vocab[i] is the word with index i.
+    """
+    inv_vocab = np.empty(max(word_idx_map.itervalues())+1, dtype=object)
+    inv_vocab[:] = ''
+    for w, i in word_idx_map.iteritems():
+        inv_vocab[i] = w
+    return inv_vocab
 
-inv_vocab = {}
-for w in word_idx_map:
-    inv_vocab[word_idx_map[w]] = w
+def to_words(inv_vocab, indices):
+    return ' '.join(inv_vocab[np.asarray(indices, dtype=np.int64)])
 
-def to_words(indices):
-    return ' '.join([inv_vocab[i] for i in indices])
-
-def generate_report(probas, k=5, group_size=10):
-    test_size = 10
+def compute_ranks(probas, group_size=10, test_size=10):
+    """
+    Rank of the true response (always first in its group) among the first
+    group_size candidates of every group. Rank 0 means it scored highest.
+    """
     n_batches = len(probas) // test_size
-    n_correct = 0
-    L_correct, L_incorrect = [], []
-    html_correct = ''
-    html_incorrect = ''
-    for i in xrange(n_batches):
-        batch = np.array(probas[i*test_size:(i+1)*test_size])[:group_size]
-        #p = np.random.permutation(len(batch))
-        #indices = p[np.argpartition(batch[p], -k)[-k:]]
-        indices = np.argpartition(batch, -k)[-k:]
-        max_idx = np.argmax(batch) + i*test_size
-        html = '<table><tr>'
-        html += '<td></td>'
-        html += '<td>%s</td></tr>' % '<br/>'.join(to_words(test_data['c'][i*test_size]).split('__eot__'))
-        for j in range(i*test_size, (i+1)*test_size):
-            html += '<tr><td>%.2f</td>' % batch[j-i*test_size]
-            html += '<td>'
-            r = to_words(test_data['r'][j])
-            if max_idx == j:
-                html += '<b>' + r + '</b>'
-            else:
-                html += r
-            html += '</td></tr>'
-        html += '</table><br/><br/>'
-        if 0 in indices:
-            L_correct.append(i)
-            html_correct += html
-        else:
-            L_incorrect.append(i)
-            html_incorrect += html
-    return L_correct, L_incorrect, html_correct, html_incorrect
-
-_, _, html_correct, _ = generate_report(test_probas, k=1)
-_, _, _, html_incorrect = generate_report(test_probas, k=5)
-with open('ubuntu_correct.html', 'wb') as f:
-    f.write('%s\n' % html_correct)
-with open('ubuntu_errors.html', 'wb') as f:
-    f.write('%s\n' % html_incorrect)
+    P = np.asarray(probas[:n_batches*test_size]).reshape((n_batches, test_size))[:, :group_size]
+    return (P[:, 1:] > P[:, :1]).sum(axis=1)
+
+class ReportWriter:
+    """
+    Streams report tables to html files, starting a new page every page_size
+    groups (page_size=0 writes everything to a single file).
+    """
+    def __init__(self, prefix, page_size=0):
+        self.prefix = prefix
+        self.page_size = page_size
+        self.n_groups = 0
+        self.n_pages = 0
+        self.f = None
+
+    def fname(self, page):
+        if self.page_size == 0:
+            return '%s.html' % self.prefix
+        return '%s_%d.html' % (self.prefix, page)
+
+    def write(self, html):
+        if self.f is None or (self.page_size > 0 and self.n_groups % self.page_size == 0):
+            self.close()
+            self.f = open(self.fname(self.n_pages), 'wb')
+            self.n_pages += 1
+        self.f.write(html)
+        self.n_groups += 1
+
+    def close(self):
+        if self.f is not None:
+            self.f.write('\n')
+            self.f.close()
+            self.f = None
+
+def group_html(test_data, inv_vocab, probas, i, test_size=10, group_size=10):
+    batch = np.asarray(probas[i*test_size:(i+1)*test_size])[:group_size]
+    max_idx = np.argmax(batch) + i*test_size
+    rows = ['<table><tr><td></td><td>%s</td></tr>' % '<br/>'.join(to_words(inv_vocab, test_data['c'][i*test_size]).split('__eot__'))]
+    for j in xrange(i*test_size, (i+1)*test_size):
+        r = to_words(inv_vocab, test_data['r'][j])
+        if max_idx == j:
+            r = '<b>' + r + '</b>'
+        rows.append('<tr><td>%.2f</td><td>%s</td></tr>' % (batch[j-i*test_size], r))
+    rows.append('</table><br/><br/>')
+    return ''.join(rows)
+
+def select_groups(mask, sample=0, rng=None):
+    indices = np.flatnonzero(mask)
+    if sample > 0 and sample < len(indices):
+        rng = rng or np.random
+        indices = np.sort(rng.choice(indices, sample, replace=False))
+    return indices
+
+def generate_report(test_data, inv_vocab, probas, correct_prefix='ubuntu_correct', errors_prefix='ubuntu_errors',
+                    k_correct=1, k_incorrect=5, group_size=10, sample=0, page_size=0, seed=42):
+    """
+    Writes the groups where the true response is ranked within the top
+    k_correct, and those where it falls outside the top k_incorrect. Ranks
+    are computed once for the whole test set and rows are streamed to disk.
+    """
+    ranks = compute_ranks(probas, group_size)
+    rng = np.random.RandomState(seed)
+    L_correct = select_groups(ranks < k_correct, sample, rng)
+    L_incorrect = select_groups(ranks >= k_incorrect, sample, rng)
+    for L, prefix in [(L_correct, correct_prefix), (L_incorrect, errors_prefix)]:
+        writer = ReportWriter(prefix, page_size)
+        for i in L:
+            writer.write(group_html(test_data, inv_vocab, probas, i, group_size=group_size))
+        writer.close()
+    return L_correct, L_incorrect
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_fname', type=str, default='dataset_ibm/blobs/dataset.pkl', help='Dataset filename, or a directory written by packed_data.py')
+    parser.add_argument('--W_fname', type=str, default='dataset_ibm/blobs/W.pkl', help='W filename')
+    parser.add_argument('--probas_fname', type=str, default='test_probas.pkl', help='Test probabilities: pickle, or .npy such as <probas_dir>/test_best_probas.npy')
+    parser.add_argument('--sample', type=int, default=0, help='Number of groups to sample per report (0 for all)')
+    parser.add_argument('--page_size', type=int, default=0, help='Groups per html page (0 for a single page)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for sampling')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.dataset_fname):
+        _, _, test_data = packed_data.load_packed(args.dataset_fname)
+        word_idx_map = load_word_idx_map(args.dataset_fname)
+    else:
+        _, _, test_data = cPickle.load(open(args.dataset_fname))
+        word_idx_map = load_word_idx_map(args.W_fname)
+    if args.probas_fname.endswith('.npy'):
+        test_probas = np.load(args.probas_fname, mmap_mode='r')
+    else:
+        test_probas = cPickle.load(open(args.probas_fname))
+    print test_probas.shape
+    inv_vocab = build_inv_vocab(word_idx_map)
 
+    L_correct, L_incorrect = generate_report(test_data, inv_vocab, test_probas, sample=args.sample,
+                                             page_size=args.page_size, seed=args.seed)
+    print 'correct: ', len(L_correct), 'incorrect: ', len(L_incorrect)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import zlib
+from collections import OrderedDict
+from twokenize import tokenize
+
+UNK_TOKEN = '**unknown**'
+OOV_TOKEN = '**oov_%d**'
+
+def oov_bucket_ids(word_idx_map):
+    """
+    Ids of the hashed OOV bucket tokens in word_idx_map, if it has any.
+    """
+    ids = []
+    while OOV_TOKEN % len(ids) in word_idx_map:
+        ids.append(word_idx_map[OOV_TOKEN % len(ids)])
+    return ids
+
+def oov_index(word, bucket_ids):
+    if isinstance(word, unicode):
+        word = word.encode('utf-8')
+    return bucket_ids[(zlib.crc32(word) & 0xffffffff) % len(bucket_ids)]
+
+def word_index(word, word_idx_map, unk_idx, bucket_ids=None):
+    """
+    Index of word, falling back to its hashed OOV bucket if word_idx_map has
+    buckets, or to unk_idx otherwise.
+    """
+    idx = word_idx_map.get(word)
+    if idx is not None:
+        return idx
+    if bucket_ids:
+        return oov_index(word, bucket_ids)
+    return unk_idx
+
+class IndexCache:
+    """
+    Bounded LRU memo in front of tokenize-and-index. Sentences are keyed by
+    their hash, so a repeated utterance costs one dictionary lookup. The
+    returned lists are shared between hits and must not be modified. Unknown
+    words go to hashed OOV buckets when word_idx_map has them.
+    """
+    def __init__(self, word_idx_map, unk_token=UNK_TOKEN, maxsize=1000000):
+        self.word_idx_map = word_idx_map
+        self.unk_idx = word_idx_map[unk_token]
+        self.bucket_ids = oov_bucket_ids(word_idx_map)
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, sent):
+        try:
+            x = self.cache.pop(sent)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            if self.bucket_ids:
+                x = [word_index(word, self.word_idx_map, self.unk_idx, self.bucket_ids) for word in tokenize(sent)]
+            else:
+                x = [self.word_idx_map.get(word, self.unk_idx) for word in tokenize(sent)]
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[sent] = x
+        return x
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total > 0 else 0.
+
+    def __str__(self):
+        return 'hits: %d misses: %d hit rate: %.4f size: %d' % (self.hits, self.misses, self.hit_rate(), len(self.cache))
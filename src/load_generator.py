@@ -0,0 +1,90 @@
+from __future__ import division
+import argparse
+import csv
+import httplib
+import json
+import numpy as np
+import socket
+import threading
+import time
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return httplib.HTTPConnection(args.host, args.port)
+
+def request(conn, method, path, body=None):
+    headers = { 'Content-Type': 'application/json' } if body is not None else {}
+    conn.request(method, path, body, headers)
+    return json.loads(conn.getresponse().read())
+
+def load_groups(fname, n_candidates=10):
+    """
+    Reads (context, candidates) ranking requests from a val/test CSV, where
+    each context is followed by its candidate responses.
+    """
+    groups = []
+    reader = csv.reader(open(fname))
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) == n_candidates:
+            groups.append({ 'context': rows[0][0], 'candidates': [r[1] for r in rows] })
+            rows = []
+    return groups
+
+def synthetic_groups(n_groups, n_candidates=10, seed=42):
+    rng = np.random.RandomState(seed)
+    words = ['ubuntu', 'install', 'sudo', 'apt-get', 'kernel', 'driver', 'thanks', 'ok', 'grub', 'boot', 'how', 'do', 'i', 'the', 'it']
+    sent = lambda n: ' '.join(rng.choice(words, n))
+    return [{ 'context': ' __eot__ '.join(sent(rng.randint(3, 20)) for _ in xrange(rng.randint(1, 6))),
+              'candidates': [sent(rng.randint(1, 20)) for _ in xrange(n_candidates)] } for _ in xrange(n_groups)]
+
+def worker(args, groups, latencies, deadline):
+    conn = connect(args)
+    i = 0
+    while time.time() < deadline:
+        body = json.dumps(groups[i % len(groups)])
+        start_time = time.time()
+        request(conn, 'POST', '/rank', body)
+        latencies.append(time.time() - start_time)
+        i += 1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Server host')
+    parser.add_argument('--port', type=int, default=8000, help='Server port')
+    parser.add_argument('--unix_socket', type=str, default='', help='Connect to this Unix socket instead of TCP')
+    parser.add_argument('--csv_fname', type=str, default='', help='val/test CSV to draw requests from (synthetic if empty)')
+    parser.add_argument('--n_candidates', type=int, default=10, help='Candidates per request')
+    parser.add_argument('--concurrency', type=int, default=16, help='Num concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='Duration in seconds')
+    args = parser.parse_args()
+
+    groups = load_groups(args.csv_fname, args.n_candidates) if args.csv_fname else synthetic_groups(1000, args.n_candidates)
+    latencies = [[] for _ in xrange(args.concurrency)]
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=worker, args=(args, groups, latencies[i], deadline)) for i in xrange(args.concurrency)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+
+    latencies = np.concatenate([np.array(l) for l in latencies]) * 1000
+    print 'requests: %d, throughput: %.1f req/s, %.1f candidates/s' % (len(latencies), len(latencies) / elapsed, len(latencies) * args.n_candidates / elapsed)
+    print 'client latency p50: %.2f ms, p99: %.2f ms' % (np.percentile(latencies, 50), np.percentile(latencies, 99))
+    print 'server stats:', request(connect(args), 'GET', '/stats')
+
+if __name__ == '__main__':
+    main()
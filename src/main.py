@@ -1,16 +1,26 @@
 from __future__ import division
 import argparse
 import cPickle
+import data_parallel
+import eval_outputs
+import json
 import lasagne
 import lasagne as nn
 import numpy as np
+import os
+import packed_data
 import pyprind
+import profiling
+import pv_data
+import shards
 import re
 import sys
 import theano
 import theano.tensor as T
 import time
+import truncation
 from collections import defaultdict, OrderedDict
+from common import compute_recall_ks, flatten_recall_ks, load_W, load_word_idx_map, recall
 from theano.ifelse import ifelse
 from theano.printing import Print as pp
 from lasagne import nonlinearities, init, utils
@@ -33,8 +43,30 @@ class GradClip(theano.compile.ViewOp):
 gradient_clipper = GradClip(-10.0, 10.0)
 #T.opt.register_canonicalize(theano.gof.OpRemove(gradient_clipper), name='gradient_clipper')
 
+def global_norm_grads(loss, params, max_norm):
+    """
+    Gradients of loss jointly rescaled so that their global L2 norm is at
+    most max_norm, and a flag telling whether that norm is NaN or Inf.
+    """
+    grads = theano.grad(loss, params)
+    norm = T.sqrt(sum(T.sqr(g).sum() for g in grads))
+    not_finite = T.or_(T.isnan(norm), T.isinf(norm))
+    scale = T.minimum(1., max_norm / (norm + 1e-7)).astype(theano.config.floatX)
+    return [g * scale for g in grads], not_finite
+
+def skip_updates_if(cond, updates, counter):
+    """
+    Leaves every variable of updates unchanged when cond holds, through a
+    single branch for the whole step, and increments counter when it does.
+    """
+    variables = [v for v, _ in updates]
+    new_values = ifelse(cond, variables, [u for _, u in updates])
+    if not isinstance(new_values, (list, tuple)):
+        new_values = [new_values]
+    return zip(variables, new_values) + [(counter, counter + cond)]
+
 def adam(loss, all_params, learning_rate=0.001, b1=0.9, b2=0.999, e=1e-8,
-         gamma=1-1e-8):
+         gamma=1-1e-8, grads=None):
     """
     ADAM update rules
     Default values are taken from [Kingma2014]
@@ -45,9 +77,10 @@ def adam(loss, all_params, learning_rate=0.001, b1=0.9, b2=0.999, e=1e-8,
     arXiv preprint arXiv:1412.6980 (2014).
     http://arxiv.org/pdf/1412.6980v4.pdf
 
+    If grads is given it is used instead of the elementwise-clipped gradients.
     """
     updates = []
-    all_grads = theano.grad(gradient_clipper(loss), all_params)
+    all_grads = theano.grad(gradient_clipper(loss), all_params) if grads is None else grads
     alpha = learning_rate
     t = theano.shared(np.float32(1))
     b1_t = b1*gamma**(t-1)   #(Decay the first moment running average coefficient)
@@ -100,6 +133,27 @@ class Model:
                  k=4,
                  n_recurrent_layers=1,
                  is_bidirectional=False,
+                 metrics_fname=None,
+                 eval_mode='pairwise',
+                 profile=False,
+                 profile_fname='',
+                 profile_every=100,
+                 theano_profile_steps=0,
+                 n_workers=1,
+                 sync_every=50,
+                 in_batch_negatives=False,
+                 in_batch_loss='softmax',
+                 truncate='head',
+                 max_turns=0,
+                 max_turn_len=0,
+                 eot_ids=(),
+                 val_every=0,
+                 val_sample_groups=0,
+                 patience=5,
+                 min_delta=0.,
+                 grad_clip='elementwise',
+                 max_grad_norm=10.,
+                 probas_dir='',
                  **kwargs):
         embedding_size = W.shape[1]
         self.data = data
@@ -116,6 +170,40 @@ class Model:
         self.emb_penalty = emb_penalty
         self.penalize_emb_norm = penalize_emb_norm
         self.penalize_emb_drift = penalize_emb_drift
+        self.metrics_fname = metrics_fname
+        self.eval_mode = eval_mode
+        self.k = k
+        self.encoder = encoder
+        self.hidden_size = hidden_size
+        self.is_bidirectional = is_bidirectional
+        self.eval_fns = None
+        self.profiler = profiling.Profiler(profile_fname, profile_every) if profile else profiling.NullProfiler()
+        self.theano_profile_steps = theano_profile_steps
+        self.n_workers = n_workers
+        self.sync_every = sync_every
+        self.parallel_trainer = None
+        self.in_batch_negatives = in_batch_negatives
+        self.truncate = truncate
+        self.max_turns = max_turns
+        self.max_turn_len = max_turn_len
+        self.eot_ids = list(eot_ids)
+        self.val_every = val_every
+        self.val_sample_groups = val_sample_groups
+        self.patience = patience
+        self.min_delta = min_delta
+        self.grad_clip = grad_clip
+        self.probas_dir = probas_dir
+        self.max_grad_norm = max_grad_norm
+        # train steps skipped by the global_norm clipping mode's NaN/Inf guard
+        self.n_skipped_updates = theano.shared(np.int64(0), name='n_skipped_updates')
+        if in_batch_negatives:
+            if use_ntn:
+                raise ValueError('in-batch negatives are only supported with the bilinear scorer')
+            # only true (c, r) pairs are trained on; the other responses in
+            # the batch serve as negatives
+            self.train_set = select_rows(data['train'], np.flatnonzero(np.asarray(data['train']['y']) == 1))
+        else:
+            self.train_set = data['train']
         if penalize_emb_drift:
             self.orig_embeddings = theano.shared(W.copy(), name='orig_embeddings', borrow=True)
 
@@ -123,6 +211,7 @@ class Model:
         c = T.imatrix('c')
         r = T.imatrix('r')
         y = T.ivector('y')
+        w = T.fvector('w')
         c_mask = T.fmatrix('c_mask')
         r_mask = T.fmatrix('r_mask')
         c_seqlen = T.ivector('c_seqlen')
@@ -323,15 +412,7 @@ class Model:
                 e_context = e_conv_context
                 e_response = e_conv_response
 
-        if use_ntn:
-            dp = T.concatenate([T.batched_dot(e_context, T.dot(e_response, self.M[i])) for i in xrange(k)], axis=1)
-            dp += T.concatenate([e_context, e_response], axis=1).dot(self.V.T) + self.b
-            dp = self.f(dp).dot(self.U)
-        else:
-            dp = T.batched_dot(e_context, T.dot(e_response, self.M.T))
-        #dp = pp('dp')(dp)
-        o = T.nnet.sigmoid(dp)
-        o = T.clip(o, 1e-7, 1.0-1e-7)
+        o = self.score(e_context, e_response)
 
         self.shared_data = {}
         for key in ['c', 'r']:
@@ -340,11 +421,16 @@ class Model:
             self.shared_data[key] = theano.shared(np.zeros((batch_size, max_seqlen), dtype=theano.config.floatX))
         for key in ['y', 'c_seqlen', 'r_seqlen']:
             self.shared_data[key] = theano.shared(np.zeros((batch_size,), dtype=np.int32))
+        self.shared_data['w'] = theano.shared(np.zeros((batch_size,), dtype=theano.config.floatX))
 
         self.probas = T.concatenate([(1-o).reshape((-1,1)), o.reshape((-1,1))], axis=1)
         self.pred = T.argmax(self.probas, axis=1)
-        self.errors = T.sum(T.neq(self.pred, y))
-        self.cost = T.nnet.binary_crossentropy(o, y).mean()
+        # w is 1 for real examples and 0 for the rows padding a final partial batch
+        self.errors = T.sum(T.neq(self.pred, y) * w)
+        if in_batch_negatives:
+            self.cost = self.in_batch_cost(e_context, e_response, w, in_batch_loss)
+        else:
+            self.cost = (T.nnet.binary_crossentropy(o, y) * w).sum() / T.maximum(w.sum(), 1)
 
         if self.penalize_emb_norm:
             self.cost += self.emb_penalty * (embeddings ** 2).sum()
@@ -367,14 +453,73 @@ class Model:
         self.c = c
         self.r = r
         self.y = y
+        self.w = w
         self.c_seqlen = c_seqlen
         self.r_seqlen = r_seqlen
         self.c_mask = c_mask
         self.r_mask = r_mask
+        self.e_context = e_context
+        self.e_response = e_response
 
         self.update_params()
 
+    def score(self, e_context, e_response):
+        if self.use_ntn:
+            dp = T.concatenate([T.batched_dot(e_context, T.dot(e_response, self.M[i])) for i in xrange(self.k)], axis=1)
+            dp += T.concatenate([e_context, e_response], axis=1).dot(self.V.T) + self.b
+            dp = self.f(dp).dot(self.U)
+        else:
+            dp = T.batched_dot(e_context, T.dot(e_response, self.M.T))
+        #dp = pp('dp')(dp)
+        o = T.nnet.sigmoid(dp)
+        return T.clip(o, 1e-7, 1.0-1e-7)
+
+    def in_batch_cost(self, e_context, e_response, w, loss='softmax'):
+        """
+        Scores every context of the batch against every response through M.
+        The diagonal holds the true pairs and all other entries are negatives.
+        Padding rows (w == 0) are neither scored nor used as negatives.
+        """
+        n = self.batch_size
+        S = T.dot(T.dot(e_context, self.M), e_response.T)
+        diag = T.arange(n)
+        n_real = T.maximum(w.sum(), 1)
+        if loss == 'softmax':
+            S = S - (1 - w.dimshuffle('x', 0)) * 1e4
+            S_max = S.max(axis=1, keepdims=True)
+            log_p = S - S_max - T.log(T.exp(S - S_max).sum(axis=1, keepdims=True))
+            return -(log_p[diag, diag] * w).sum() / n_real
+        elif loss == 'sigmoid':
+            eye = T.eye(n, dtype=theano.config.floatX)
+            o = T.clip(T.nnet.sigmoid(S), 1e-7, 1.0-1e-7)
+            # positives and negatives get equal total weight
+            weights = eye * (0.5 / n_real) + (1 - eye) * (0.5 / T.maximum(n_real * (n_real-1), 1))
+            weights *= w.dimshuffle(0, 'x') * w.dimshuffle('x', 0)
+            return (T.nnet.binary_crossentropy(o, eye) * weights).sum()
+        raise ValueError('Unsupported in-batch loss: %s' % loss)
+
+    def compile_eval_fns(self):
+        """
+        Compiles separate context and response encoders, plus a scorer that
+        takes encodings of any batch size. Used by the grouped evaluation mode.
+        """
+        encode_c = theano.function([], self.e_context, on_unused_input='ignore', givens={
+            self.c: self.shared_data['c'],
+            self.c_seqlen: self.shared_data['c_seqlen'],
+            self.c_mask: self.shared_data['c_mask']
+        })
+        encode_r = theano.function([], self.e_response, on_unused_input='ignore', givens={
+            self.r: self.shared_data['r'],
+            self.r_seqlen: self.shared_data['r_seqlen'],
+            self.r_mask: self.shared_data['r_mask']
+        })
+        ec = T.matrix('ec', dtype=theano.config.floatX)
+        er = T.matrix('er', dtype=theano.config.floatX)
+        get_scores = theano.function([ec, er], self.score(ec, er))
+        self.eval_fns = { 'c': encode_c, 'r': encode_r, 'score': get_scores }
+
     def update_params(self):
+        start_time = time.time()
         params = lasagne.layers.get_all_params(self.l_out)
         if self.use_ntn:
             params += [self.U, self.V, self.M, self.b]
@@ -388,60 +533,240 @@ class Model:
         total_params = sum([p.get_value().size for p in params])
         print "total_params: ", total_params
 
+        if self.grad_clip == 'global_norm':
+            grads, not_finite = global_norm_grads(self.cost, params, self.max_grad_norm)
+        elif self.grad_clip == 'elementwise':
+            grads, not_finite = None, None
+        else:
+            raise ValueError('Unsupported gradient clipping: %s' % self.grad_clip)
+
         if 'adam' == self.optimizer:
-            updates = adam(self.cost, params, learning_rate=self.lr)
+            updates = adam(self.cost, params, learning_rate=self.lr, grads=grads)
         elif 'adadelta' == self.optimizer:
-            updates = sgd_updates_adadelta(self.cost, params, self.lr_decay, 1e-6, self.sqr_norm_lim)
+            updates = sgd_updates_adadelta(self.cost, params, self.lr_decay, 1e-6, self.sqr_norm_lim, grads=grads)
 #            updates = lasagne.updates.adadelta(self.cost, params, learning_rate=1.0, rho=self.lr_decay)
         else:
             raise 'Unsupported optimizer: %s' % self.optimizer
+        updates = updates.items() if isinstance(updates, dict) else updates
+        # parameters and optimizer state, in a fixed order
+        self.updated_vars = [u[0] for u in updates]
+        if not_finite is not None:
+            updates = skip_updates_if(not_finite, updates, self.n_skipped_updates)
 
         givens = {
             self.c: self.shared_data['c'],
             self.r: self.shared_data['r'],
             self.y: self.shared_data['y'],
+            self.w: self.shared_data['w'],
             self.c_seqlen: self.shared_data['c_seqlen'],
             self.r_seqlen: self.shared_data['r_seqlen'],
             self.c_mask: self.shared_data['c_mask'],
             self.r_mask: self.shared_data['r_mask']
         }
-        self.train_model = theano.function([], self.cost, updates=updates, givens=givens, on_unused_input='warn')
+        self.train_updates, self.train_givens = updates, givens
+        # profiled while steps of the theano_profile_steps budget remain
+        self.train_model = self.compile_train_model(profile=self.theano_profile_steps > 0)
         self.get_loss = theano.function([], self.errors, givens=givens, on_unused_input='warn')
         self.get_probas = theano.function([], self.probas, givens=givens, on_unused_input='warn')
 
-    def get_batch(self, dataset, index, max_l):
+        self.shared_vars = list(set(params + self.updated_vars + self.shared_data.values() + [self.embeddings]))
+        self.profiler.add_time('update_params', time.time() - start_time)
+
+    def compile_train_model(self, profile=False):
+        return theano.function([], self.cost, updates=self.train_updates, givens=self.train_givens,
+                               on_unused_input='warn', profile=profile)
+
+    def shared_bytes(self):
+        return sum(v.get_value(borrow=True).nbytes for v in self.shared_vars)
+
+    def export_params(self, fname):
+        """
+        Saves everything needed to run the rnn/lstm/gru encoders and the scorer
+        without Theano to an .npz file, read by numpy_inference.py.
+        """
+        if self.conv_attn or self.encoder.find('cnn') > -1:
+            raise ValueError('export is only supported for rnn, lstm and gru encoders')
+        if self.is_bidirectional:
+            directions = [('fwd', self.l_recurrent.input_layers[0]), ('bck', self.l_recurrent.input_layers[1])]
+        else:
+            directions = [('fwd', self.l_recurrent)]
+        arrays = { 'embeddings': self.embeddings.get_value(), 'M': self.M.get_value() }
+        if self.use_ntn:
+            for name in ['U', 'V', 'b']:
+                arrays[name] = getattr(self, name).get_value()
+        n_layers = 0
+        for direction, layer in directions:
+            layers = []
+            while not isinstance(layer, InputLayer):
+                layers.append(layer)
+                layer = layer.input_layer
+            n_layers = len(layers)
+            for i, layer in enumerate(reversed(layers)):
+                for name, value in recurrent_layer_params(layer).iteritems():
+                    arrays['%s_%d_%s' % (direction, i, name)] = value
+        config = {
+            'encoder': self.encoder,
+            'is_bidirectional': self.is_bidirectional,
+            'n_recurrent_layers': n_layers,
+            'hidden_size': self.hidden_size,
+            'max_seqlen': self.max_seqlen,
+            'use_ntn': self.use_ntn,
+            'k': self.k,
+            'truncate': self.truncate,
+            'max_turns': self.max_turns,
+            'max_turn_len': self.max_turn_len,
+            'eot_ids': self.eot_ids
+        }
+        arrays['config'] = np.array(json.dumps(config))
+        np.savez(fname, **arrays)
+
+    def get_batch(self, dataset, index, max_l, strategy='head'):
         seqlen = np.zeros((self.batch_size,), dtype=np.int32)
         mask = np.zeros((self.batch_size,max_l), dtype=theano.config.floatX)
         batch = np.zeros((self.batch_size, max_l), dtype=np.int32)
         data = dataset[index*self.batch_size:(index+1)*self.batch_size]
         for i,row in enumerate(data):
-            row = row[:max_l]
+            row = truncation.truncate(row, max_l, strategy, self.eot_ids, self.max_turns, self.max_turn_len)
             batch[i,0:len(row)] = row
             seqlen[i] = len(row)-1
             mask[i,0:len(row)] = 1
         return batch, seqlen, mask
 
     def set_shared_variables(self, dataset, index):
-        c, c_seqlen, c_mask = self.get_batch(dataset['c'], index, self.max_seqlen)
+        """
+        Loads minibatch index of dataset into the shared variables and returns
+        its number of examples. A final partial batch is zero-padded, and the
+        padding rows get weight 0.
+        """
+        c, c_seqlen, c_mask = self.get_batch(dataset['c'], index, self.max_seqlen, self.truncate)
         r, r_seqlen, r_mask = self.get_batch(dataset['r'], index, self.max_seqlen)
-        y = np.array(dataset['y'][index*self.batch_size:(index+1)*self.batch_size], dtype=np.int32)
+        n = min(self.batch_size, len(dataset['y']) - index*self.batch_size)
+        y = np.zeros((self.batch_size,), dtype=np.int32)
+        y[:n] = dataset['y'][index*self.batch_size:index*self.batch_size+n]
+        w = np.zeros((self.batch_size,), dtype=theano.config.floatX)
+        w[:n] = 1
         self.shared_data['c'].set_value(c)
         self.shared_data['r'].set_value(r)
         self.shared_data['y'].set_value(y)
+        self.shared_data['w'].set_value(w)
         self.shared_data['c_seqlen'].set_value(c_seqlen)
         self.shared_data['r_seqlen'].set_value(r_seqlen)
         self.shared_data['c_mask'].set_value(c_mask)
         self.shared_data['r_mask'].set_value(r_mask)
+        return n
+
+    def n_batches(self, dataset):
+        return (len(dataset['y']) + self.batch_size - 1) // self.batch_size
 
     def compute_loss(self, dataset, index):
         self.set_shared_variables(dataset, index)
         return self.get_loss()
 
     def compute_probas(self, dataset, index):
-        self.set_shared_variables(dataset, index)
-        return self.get_probas()[:,1]
+        n = self.set_shared_variables(dataset, index)
+        return self.get_probas()[:n,1]
+
+    def compute_encodings(self, seqs, key):
+        """
+        Encodes every sequence in seqs with the context (key='c') or response
+        (key='r') encoder, one batch_size-sized batch at a time.
+        """
+        n_batches = (len(seqs) + self.batch_size - 1) // self.batch_size
+        encodings = []
+        for i in xrange(n_batches):
+            batch, seqlen, mask = self.get_batch(seqs, i, self.max_seqlen, self.truncate if key == 'c' else 'head')
+            self.shared_data[key].set_value(batch)
+            self.shared_data['%s_seqlen' % key].set_value(seqlen)
+            self.shared_data['%s_mask' % key].set_value(mask)
+            encodings.append(self.eval_fns[key]())
+        return np.concatenate(encodings)[:len(seqs)]
+
+    def compute_grouped_probas(self, dataset, group_size=10, chunk_size=10000):
+        """
+        Computes probas for datasets made of groups of group_size rows sharing
+        one context (val and test). Each context is encoded once, and the
+        cached encoding is scored against all the responses of its group.
+        Contexts stored as packed_data.GroupedSequences are encoded once per
+        unique context, using their per-row context ids.
+        """
+        if self.eval_fns is None:
+            self.compile_eval_fns()
+        n_groups = len(dataset['y']) // group_size
+        if isinstance(dataset['c'], packed_data.GroupedSequences):
+            e_c = self.compute_encodings(dataset['c'].seqs, 'c')
+            group_ids = np.asarray(dataset['c'].ids[:n_groups*group_size])
+        else:
+            e_c = self.compute_encodings(dataset['c'][:n_groups*group_size:group_size], 'c')
+            group_ids = np.arange(n_groups*group_size) // group_size
+        e_r = self.compute_encodings(dataset['r'][:n_groups*group_size], 'r')
+        probas = []
+        for i in xrange(0, len(e_r), chunk_size):
+            probas.append(self.eval_fns['score'](e_c[group_ids[i:i+chunk_size]], e_r[i:i+chunk_size]))
+        return np.concatenate(probas)
+
+    def evaluate(self, dataset, n_batches, name=None):
+        """
+        Returns accuracy and probas on dataset, both derived from a single
+        pass over it. If probas_dir is set and a name is given, probas are
+        streamed batch by batch to <probas_dir>/<name>_probas.npy, along with
+        labels and group ids, and returned memory-mapped.
+        """
+        n = len(dataset['y'])
+        if self.eval_mode == 'grouped':
+            # compute_grouped_probas only scores complete groups
+            n -= n % 10
+        writer = None
+        if self.probas_dir and name:
+            writer = eval_outputs.ProbaWriter('%s/%s' % (self.probas_dir, name), dataset['y'][:n],
+                                              dataset_group_ids(dataset, n))
+        # predictions are argmax([1-p, p]), i.e. 1 iff p > 0.5
+        n_correct = 0
+        if self.eval_mode == 'grouped':
+            probas = self.compute_grouped_probas(dataset)
+            n_correct = np.sum((probas > 0.5) == np.asarray(dataset['y'][:n], dtype=np.int32))
+            if writer is not None:
+                writer.write(0, probas)
+        else:
+            probas = []
+            for i in xrange(n_batches):
+                start = i*self.batch_size
+                p = self.compute_probas(dataset, i)
+                self.profiler.count('eval_batches')
+                n_correct += np.sum((p > 0.5) == np.asarray(dataset['y'][start:start+len(p)], dtype=np.int32))
+                if writer is not None:
+                    writer.write(start, p)
+                else:
+                    probas.append(p)
+            if writer is None:
+                probas = np.concatenate(probas)
+        perf = n_correct / max(n, 1)
+        if writer is not None:
+            probas = writer.close()
+        return perf, probas
 
     def train(self, n_epochs=100, shuffle_batch=False):
+        try:
+            if self.val_every > 0:
+                return self.train_with_patience(n_epochs, shuffle_batch)
+            return self.train_epochs(n_epochs, shuffle_batch)
+        finally:
+            if self.parallel_trainer is not None:
+                self.parallel_trainer.close()
+                self.parallel_trainer = None
+
+    def get_parallel_trainer(self):
+        """
+        The DataParallelTrainer of this train() call, restarted when
+        update_params has replaced the trained variables.
+        """
+        if self.parallel_trainer is not None and self.parallel_trainer.state_vars is not self.updated_vars:
+            self.parallel_trainer.close()
+            self.parallel_trainer = None
+        if self.parallel_trainer is None:
+            self.parallel_trainer = data_parallel.DataParallelTrainer(self, self.n_workers, self.sync_every)
+        return self.parallel_trainer
+
+    def train_epochs(self, n_epochs=100, shuffle_batch=False):
         epoch = 0
         best_val_perf = 0
         best_val_rk1 = 0
@@ -449,43 +774,50 @@ class Model:
         test_probas = None
         cost_epoch = 0
 
-        n_train_batches = len(self.data['train']['y']) // self.batch_size
-        n_val_batches = len(self.data['val']['y']) // self.batch_size
-        n_test_batches = len(self.data['test']['y']) // self.batch_size
+        n_train_batches = self.n_batches(self.train_set)
+        n_train_eval_batches = self.n_batches(self.data['train'])
+        n_val_batches = self.n_batches(self.data['val'])
+        n_test_batches = self.n_batches(self.data['test'])
 
         while (epoch < n_epochs):
             epoch += 1
             indices = range(n_train_batches)
             if shuffle_batch:
                 indices = np.random.permutation(indices)
-            bar = pyprind.ProgBar(len(indices), monitor=True)
-            total_cost = 0
+            record = { 'event': 'epoch', 'epoch': epoch }
             start_time = time.time()
-            for minibatch_index in indices:
-                self.set_shared_variables(self.data['train'], minibatch_index)
-                cost_epoch = self.train_model()
-                total_cost += cost_epoch
-                self.set_zero(self.zero_vec)
-                bar.update()
+            prof = self.profiler
+            if self.n_workers > 1:
+                total_cost, n_steps = self.get_parallel_trainer().run(indices)
+            else:
+                total_cost, n_steps = self.train_steps(indices, pyprind.ProgBar(len(indices), monitor=True)), len(indices)
             end_time = time.time()
-            print "cost: ", (total_cost / len(indices)), " took: %d(s)" % (end_time - start_time)
-            train_losses = [self.compute_loss(self.data['train'], i) for i in xrange(n_train_batches)]
-            train_perf = 1 - np.sum(train_losses) / len(self.data['train']['y'])
-            val_losses = [self.compute_loss(self.data['val'], i) for i in xrange(n_val_batches)]
-            val_perf = 1 - np.sum(val_losses) / len(self.data['val']['y'])
+            print "cost: ", (total_cost / n_steps), " took: %d(s)" % (end_time - start_time)
+            record['cost'] = float(total_cost / n_steps)
+            record['train_time'] = end_time - start_time
+            if self.grad_clip == 'global_norm':
+                record['skipped_updates'] = int(self.n_skipped_updates.get_value())
+            start_time = time.time()
+            with prof.timer('eval_train'):
+                train_losses = [self.compute_loss(self.data['train'], i) for i in xrange(n_train_eval_batches)]
+                train_perf = 1 - np.sum(train_losses) / len(self.data['train']['y'])
+            with prof.timer('eval_val'):
+                val_perf, val_probas = self.evaluate(self.data['val'], n_val_batches, 'val_epoch%d' % epoch)
             print 'epoch %i, train_perf %f, val_perf %f' % (epoch, train_perf*100, val_perf*100)
 
-            val_probas = np.concatenate([self.compute_probas(self.data['val'], i) for i in xrange(n_val_batches)])
             val_recall_k = self.compute_recall_ks(val_probas)
+            record.update({ 'train_perf': float(train_perf), 'val_perf': float(val_perf) })
+            record.update(flatten_recall_ks(val_recall_k, 'val'))
 
             if val_perf > best_val_perf or val_recall_k[10][1] > best_val_rk1:
                 best_val_perf = val_perf
                 best_val_rk1 = val_recall_k[10][1]
-                test_losses = [self.compute_loss(self.data['test'], i) for i in xrange(n_test_batches)]
-                test_perf = 1 - np.sum(test_losses) / len(self.data['test']['y'])
+                with prof.timer('eval_test'):
+                    test_perf, test_probas = self.evaluate(self.data['test'], n_test_batches, 'test_best')
                 print 'test_perf: %f' % (test_perf*100)
-                test_probas = np.concatenate([self.compute_probas(self.data['test'], i) for i in xrange(n_test_batches)])
-                self.compute_recall_ks(test_probas)
+                test_recall_k = self.compute_recall_ks(test_probas)
+                record['test_perf'] = float(test_perf)
+                record.update(flatten_recall_ks(test_recall_k, 'test'))
             else:
                 if not self.fine_tune_W:
                     self.fine_tune_W = True # try fine-tuning W
@@ -493,33 +825,195 @@ class Model:
                     if not self.fine_tune_M:
                         self.fine_tune_M = True # try fine-tuning M
                     else:
+                        record['eval_time'] = time.time() - start_time
+                        self.log_metrics(record)
+                        prof.report(epoch=epoch)
                         break
                 self.update_params()
+            record['eval_time'] = time.time() - start_time
+            self.log_metrics(record)
+            prof.sample_memory(self.shared_bytes)
+            prof.report(epoch=epoch)
+        return test_perf, test_probas
+
+    def train_with_patience(self, n_epochs=100, shuffle_batch=False):
+        """
+        Validates every val_every steps on a fixed, length-stratified sample of
+        val_sample_groups complete val groups (all of val if 0). Full val and
+        test are evaluated only when the sample's recall@1 improves on its best
+        by more than min_delta, and training stops after patience checks
+        without such an improvement.
+        """
+        if self.val_sample_groups > 0:
+            val_sample = select_rows(self.data['val'], stratified_groups(self.data['val'], self.val_sample_groups))
+        else:
+            val_sample = self.data['val']
+        n_train_batches = self.n_batches(self.train_set)
+        n_val_batches = self.n_batches(self.data['val'])
+        n_test_batches = self.n_batches(self.data['test'])
+        n_val_sample_batches = self.n_batches(val_sample)
+        prof = self.profiler
+        best_rk1 = -1
+        n_bad_checks = 0
+        n_steps_total = 0
+        test_perf = 0
+        test_probas = None
+
+        for epoch in xrange(1, n_epochs+1):
+            indices = range(n_train_batches)
+            if shuffle_batch:
+                indices = np.random.permutation(indices)
+            bar = pyprind.ProgBar(len(indices), monitor=True) if self.n_workers == 1 else None
+            for start in xrange(0, len(indices), self.val_every):
+                chunk = indices[start:start+self.val_every]
+                start_time = time.time()
+                if self.n_workers > 1:
+                    total_cost, n_steps = self.get_parallel_trainer().run(chunk)
+                else:
+                    total_cost, n_steps = self.train_steps(chunk, bar), len(chunk)
+                n_steps_total += n_steps
+                record = { 'event': 'epoch', 'epoch': epoch, 'step': n_steps_total,
+                           'cost': float(total_cost / n_steps), 'train_time': time.time() - start_time }
+                if self.grad_clip == 'global_norm':
+                    record['skipped_updates'] = int(self.n_skipped_updates.get_value())
+                start_time = time.time()
+                with prof.timer('eval_val_sample'):
+                    _, probas = self.evaluate(val_sample, n_val_sample_batches)
+                rk1 = self.recall(probas, 1, 10)
+                record['val_sample_r1@10'] = float(rk1)
+                print 'epoch %i, step %i, val sample recall@1: %f' % (epoch, n_steps_total, rk1)
+                if rk1 > best_rk1 + self.min_delta:
+                    best_rk1 = rk1
+                    n_bad_checks = 0
+                    with prof.timer('eval_val'):
+                        val_perf, val_probas = self.evaluate(self.data['val'], n_val_batches, 'val_best')
+                    with prof.timer('eval_test'):
+                        test_perf, test_probas = self.evaluate(self.data['test'], n_test_batches, 'test_best')
+                    print 'val_perf: %f, test_perf: %f' % (val_perf*100, test_perf*100)
+                    record.update({ 'val_perf': float(val_perf), 'test_perf': float(test_perf) })
+                    record.update(flatten_recall_ks(self.compute_recall_ks(val_probas), 'val'))
+                    record.update(flatten_recall_ks(self.compute_recall_ks(test_probas), 'test'))
+                else:
+                    n_bad_checks += 1
+                record['eval_time'] = time.time() - start_time
+                self.log_metrics(record)
+                if n_bad_checks >= self.patience:
+                    print 'no improvement in %d checks, stopping' % n_bad_checks
+                    prof.report(epoch=epoch)
+                    return test_perf, test_probas
+            prof.sample_memory(self.shared_bytes)
+            prof.report(epoch=epoch)
         return test_perf, test_probas
 
+    def train_steps(self, indices, bar=None, sync_fn=None, sync_every=1, sync_until=None):
+        """
+        Runs one train_model step per minibatch index and returns the summed
+        cost. If sync_fn is given, it is called every sync_every steps before
+        step sync_until (default: len(indices)) and once after the last step,
+        so that replicas with different numbers of steps sync equally often.
+        """
+        if sync_until is None:
+            sync_until = len(indices)
+        total_cost = 0
+        prof = self.profiler
+        count_skipped = prof.enabled and self.grad_clip == 'global_norm'
+        if count_skipped:
+            n_skipped = self.n_skipped_updates.get_value()
+        for step, minibatch_index in enumerate(indices):
+            with prof.timer('get_batch'):
+                self.set_shared_variables(self.train_set, minibatch_index)
+            with prof.timer('train_model'):
+                cost_epoch = self.train_model()
+            if self.theano_profile_steps > 0:
+                self.theano_profile_steps -= 1
+                if self.theano_profile_steps == 0:
+                    self.train_model.profile.summary()
+                    # the budget is used up: later steps run unprofiled
+                    self.train_model = self.compile_train_model()
+            prof.count('train_batches')
+            total_cost += cost_epoch
+            with prof.timer('set_zero'):
+                self.set_zero(self.zero_vec)
+            if sync_fn is not None and (((step+1) % sync_every == 0 and step+1 < sync_until) or step == len(indices)-1):
+                with prof.timer('sync'):
+                    sync_fn()
+                prof.count('syncs')
+            prof.step(self.shared_bytes)
+            if bar is not None:
+                bar.update()
+        if count_skipped:
+            prof.count('skipped_updates', int(self.n_skipped_updates.get_value() - n_skipped))
+        return total_cost
+
+    def log_metrics(self, record):
+        """
+        Emits one JSON record per line, both to stdout (prefixed with
+        'metrics: ') and, if metrics_fname is set, to that file.
+        """
+        line = json.dumps(record, sort_keys=True)
+        print 'metrics: %s' % line
+        if self.metrics_fname:
+            with open(self.metrics_fname, 'ab') as f:
+                f.write(line + '\n')
+
     def compute_recall_ks(self, probas):
-      recall_k = {}
-      for group_size in [2, 5, 10]:
-          recall_k[group_size] = {}
-          print 'group_size: %d' % group_size
-          for k in [1, 2, 5]:
-              if k < group_size:
-                  recall_k[group_size][k] = self.recall(probas, k, group_size)
-                  print 'recall@%d' % k, recall_k[group_size][k]
-      return recall_k
+        return compute_recall_ks(probas)
 
     def recall(self, probas, k, group_size):
-        test_size = 10
-        n_batches = len(probas) // test_size
-        n_correct = 0
-        for i in xrange(n_batches):
-            batch = np.array(probas[i*test_size:(i+1)*test_size])[:group_size]
-            #p = np.random.permutation(len(batch))
-            #indices = p[np.argpartition(batch[p], -k)[-k:]]
-            indices = np.argpartition(batch, -k)[-k:]
-            if 0 in indices:
-                n_correct += 1
-        return n_correct / (len(probas) / test_size)
+        return recall(probas, k, group_size)
+
+def select_rows(dataset, indices):
+    return dict((key, [dataset[key][i] for i in indices]) for key in ['c', 'r', 'y'])
+
+def dataset_group_ids(dataset, n, group_size=10):
+    """
+    Group of each of the first n rows: the stored context id for contexts
+    kept as packed_data.GroupedSequences, otherwise consecutive blocks of
+    group_size rows.
+    """
+    if isinstance(dataset['c'], packed_data.GroupedSequences):
+        return np.asarray(dataset['c'].ids[:n], dtype=np.int32)
+    return np.arange(n, dtype=np.int32) // group_size
+
+def stratified_groups(dataset, n_groups, group_size=10, n_strata=10, seed=42):
+    """
+    Row indices of n_groups complete groups of dataset, drawn evenly from
+    n_strata strata of context length so that the sample keeps the length
+    distribution of the full set.
+    """
+    n_total = len(dataset['y']) // group_size
+    if n_groups >= n_total:
+        return range(n_total * group_size)
+    lengths = np.array([len(dataset['c'][g*group_size]) for g in xrange(n_total)])
+    rng = np.random.RandomState(seed)
+    strata = np.array_split(np.argsort(lengths, kind='mergesort'), n_strata)
+    groups = []
+    for i, stratum in enumerate(strata):
+        n = n_groups * (i+1) // n_strata - n_groups * i // n_strata
+        groups.extend(rng.choice(stratum, min(n, len(stratum)), replace=False))
+    return [g*group_size + j for g in sorted(groups) for j in xrange(group_size)]
+
+def recurrent_layer_params(layer):
+    if isinstance(layer, lasagne.layers.LSTMLayer):
+        names = ['W_in_to_%s', 'W_hid_to_%s', 'b_%s']
+        params = dict((name % gate, getattr(layer, name % gate).get_value())
+                      for gate in ['ingate', 'forgetgate', 'cell', 'outgate'] for name in names)
+        for gate in ['ingate', 'forgetgate', 'outgate']:
+            params['W_cell_to_%s' % gate] = getattr(layer, 'W_cell_to_%s' % gate).get_value()
+        params['cell_init'] = layer.cell_init.get_value()
+    elif isinstance(layer, lasagne.layers.GRULayer):
+        names = ['W_in_to_%s', 'W_hid_to_%s', 'b_%s']
+        params = dict((name % gate, getattr(layer, name % gate).get_value())
+                      for gate in ['resetgate', 'updategate', 'hidden_update'] for name in names)
+    else:
+        params = {
+            'W_in_to_hid': layer.input_to_hidden.W.get_value(),
+            'b': layer.input_to_hidden.b.get_value(),
+            'W_hid_to_hid': layer.hidden_to_hidden.W.get_value()
+        }
+    params['hid_init'] = layer.hid_init.get_value()
+    params['backwards'] = np.array(layer.backwards)
+    return params
 
 def as_floatX(variable):
     if isinstance(variable, float):
@@ -529,15 +1023,15 @@ def as_floatX(variable):
         return np.cast[theano.config.floatX](variable)
     return theano.tensor.cast(variable, theano.config.floatX)
 
-def sgd_updates_adadelta(cost, params, rho=0.95, epsilon=1e-6, norm_lim=9, word_vec_name='embeddings'):
+def sgd_updates_adadelta(cost, params, rho=0.95, epsilon=1e-6, norm_lim=9, word_vec_name='embeddings', grads=None):
     updates = OrderedDict({})
     exp_sqr_grads = OrderedDict({})
     exp_sqr_ups = OrderedDict({})
     gparams = []
-    for param in params:
+    for i, param in enumerate(params):
         empty = np.zeros_like(param.get_value())
         exp_sqr_grads[param] = theano.shared(value=as_floatX(empty),name="exp_grad_%s" % param.name)
-        gp = T.grad(cost, param)
+        gp = T.grad(cost, param) if grads is None else grads[i]
         exp_sqr_ups[param] = theano.shared(value=as_floatX(empty), name="exp_grad_%s" % param.name)
         gparams.append(gp)
     for param, gp in zip(params, gparams):
@@ -557,32 +1051,6 @@ def sgd_updates_adadelta(cost, params, rho=0.95, epsilon=1e-6, norm_lim=9, word_
             updates[param] = stepped_param
     return updates
 
-def pad_to_batch_size(X, batch_size):
-    n_seqs = len(X)
-    n_batches_out = np.ceil(float(n_seqs) / batch_size)
-    n_seqs_out = batch_size * n_batches_out
-
-    to_pad = n_seqs % batch_size
-    if to_pad > 0:
-        X += X[:batch_size-to_pad]
-    return X
-
-def get_nrows(fname):
-    with open(fname, 'rb') as f:
-        nrows = 0
-        for _ in f:
-            nrows += 1
-        return nrows
-
-def load_pv_vecs(fname, ndims):
-    nrows = get_nrows(fname)
-    with open(fname, "rb") as f:
-        X = np.zeros((nrows+1, ndims))
-        for i,line in enumerate(f):
-            L = line.strip().split()
-            X[i+1] = np.array(L[1:], dtype='float32')
-        return X
-
 def sort_by_len(dataset):
     c, r, y = dataset['c'], dataset['r'], dataset['y']
     indices = range(len(y))
@@ -612,7 +1080,11 @@ def main():
   parser.add_argument('--forget_gate_bias', type=float, default=2.0, help='Forget gate bias')
   parser.add_argument('--use_pv', type='bool', default=False, help='Use PV')
   parser.add_argument('--pv_ndims', type=int, default=100, help='PV ndims')
+  parser.add_argument('--pv_dir', type=str, default='../data/pv_packed', help='PV data converted by pv_data.py')
   parser.add_argument('--max_seqlen', type=int, default=160, help='Max seqlen')
+  parser.add_argument('--truncate', type=str, default='head', help='Context truncation: head, tail, turns or turn_cap')
+  parser.add_argument('--max_turns', type=int, default=0, help='With --truncate=turns, num most recent turns kept')
+  parser.add_argument('--max_turn_len', type=int, default=0, help='With --truncate=turn_cap, max tokens kept per turn')
   parser.add_argument('--corr_penalty', type=float, default=0.0, help='Correlation penalty')
   parser.add_argument('--xcov_penalty', type=float, default=0.0, help='XCov penalty')
   parser.add_argument('--n_recurrent_layers', type=int, default=1, help='Num recurrent layers')
@@ -630,26 +1102,55 @@ def main():
   parser.add_argument('--use_ntn', type='bool', default=False, help='Whether to use NTN')
   parser.add_argument('--k', type=int, default=4, help='Size of k in NTN')
   parser.add_argument('--seed', type=int, default=42, help='Random seed')
+  parser.add_argument('--eval_mode', type=str, default='pairwise', help='Evaluation mode: pairwise, or grouped to encode each val/test context once')
+  parser.add_argument('--export_fname', type=str, default='', help='Export parameters for numpy_inference.py to this .npz file')
+  parser.add_argument('--profile', type='bool', default=False, help='Time and sample memory of each training phase')
+  parser.add_argument('--profile_fname', type=str, default='', help='File to append per-epoch JSON profiles to')
+  parser.add_argument('--profile_every', type=int, default=100, help='Sample memory every this many steps')
+  parser.add_argument('--theano_profile_steps', type=int, default=0, help='Run the first this many train steps with Theano\'s profiler and print its summary')
+  parser.add_argument('--n_workers', type=int, default=1, help='Num data-parallel training processes')
+  parser.add_argument('--sync_every', type=int, default=50, help='Average worker parameters and optimizer state every this many steps (each sync moves ~3x the parameters through shared memory)')
+  parser.add_argument('--in_batch_negatives', type='bool', default=False, help='Train on true pairs only, using the other responses in the batch as negatives')
+  parser.add_argument('--in_batch_loss', type=str, default='softmax', help='In-batch loss: softmax or sigmoid')
+  parser.add_argument('--grad_clip', type=str, default='elementwise', help='Gradient clipping: elementwise, or global_norm with one NaN/Inf guard per step')
+  parser.add_argument('--max_grad_norm', type=float, default=10., help='With --grad_clip=global_norm, max global gradient norm')
+  parser.add_argument('--val_every', type=int, default=0, help='Validate every this many steps, with patience-based stopping (0: once per epoch)')
+  parser.add_argument('--val_sample_groups', type=int, default=0, help='With --val_every, num val groups in the stratified validation sample (0 for all)')
+  parser.add_argument('--patience', type=int, default=5, help='With --val_every, stop after this many checks without improvement')
+  parser.add_argument('--min_delta', type=float, default=0., help='With --val_every, min recall@1 gain that counts as an improvement')
+  parser.add_argument('--probas_dir', type=str, default='', help='Stream val/test probas, labels and group ids to .npy files in this directory')
+  parser.add_argument('--metrics_fname', type=str, default='', help='File to append per-epoch JSON metrics to')
   args = parser.parse_args()
   print 'args:', args
+  print 'metrics: %s' % json.dumps(dict(args.__dict__, event='args'), sort_keys=True)
   np.random.seed(args.seed)
 
   print "loading data...",
   if args.use_pv:
-      data = cPickle.load(open('../data/all_pv.pkl'))
-      train_data = { 'c': data['c'][:1000000], 'r': data['r'][:1000000], 'y': data['y'][:1000000] }
-      val_data = { 'c': data['c'][1000000:1356080], 'r': data['r'][1000000:1356080], 'y': data['y'][1000000:1356080] }
-      test_data = { 'c': data['c'][1000000+356080:], 'r': data['r'][1000000+356080:], 'y': data['y'][1000000+356080:] }
-
-      for key in ['c', 'r', 'y']:
-          for dataset in [train_data, val_data]:
-              dataset[key] = pad_to_batch_size(dataset[key], args.batch_size)
-
-      W = load_pv_vecs('../data/pv_vectors_%dd.txt' % args.pv_ndims, args.pv_ndims)
+      if not (os.path.exists('%s/meta.json' % args.pv_dir) and os.path.exists('%s/pv_vectors_%dd.npy' % (args.pv_dir, args.pv_ndims))):
+          # one-time conversion; meta.json is written last, and later runs
+          # memory-map the result with the split sizes it records
+          pv_data.convert_pv('../data/all_pv.pkl', '../data/pv_vectors_%dd.txt' % args.pv_ndims, args.pv_dir, args.pv_ndims)
+      train_data, val_data, test_data, W = pv_data.load_pv(args.pv_dir, args.pv_ndims)
       args.max_seqlen = 21
   else:
-      train_data, val_data, test_data = cPickle.load(open('%s/%s' % (args.input_dir, args.dataset_fname), 'rb'))
-      W, _ = cPickle.load(open('%s/%s' % (args.input_dir, args.W_fname), 'rb'))
+      dataset_path = '%s/%s' % (args.input_dir, args.dataset_fname)
+      if os.path.exists('%s/manifest.json' % dataset_path):
+          # shard store: the packed dataset plus every ingested shard
+          train_data, val_data, test_data = shards.load_shards(dataset_path)
+          W = shards.load_W(dataset_path)
+      elif os.path.isdir(dataset_path):
+          train_data, val_data, test_data = packed_data.load_packed(dataset_path)
+          W = load_W('%s/%s' % (args.input_dir, args.W_fname))
+      else:
+          train_data, val_data, test_data = cPickle.load(open(dataset_path, 'rb'))
+          W = load_W('%s/%s' % (args.input_dir, args.W_fname))
+      if args.truncate in ['turns', 'turn_cap']:
+          if os.path.exists('%s/manifest.json' % dataset_path):
+              word_idx_map = shards.load_word_idx_map(dataset_path)
+          else:
+              word_idx_map = load_word_idx_map('%s/%s' % (args.input_dir, args.W_fname))
+          args.eot_ids = truncation.find_eot_ids(word_idx_map)
   print "data loaded!"
 
   args.data = { 'train' : train_data, 'val': val_data, 'test': test_data }
@@ -658,12 +1159,19 @@ def main():
   if args.sort_by_len:
       sort_by_len(data['train'])
 
+  if args.probas_dir and not os.path.exists(args.probas_dir):
+      os.makedirs(args.probas_dir)
   model = Model(**args.__dict__)
   _, test_probas = model.train(n_epochs=args.n_epochs, shuffle_batch=args.shuffle_batch)
 
   if args.save_model:
       cPickle.dump(model, open(args.model_fname, 'wb'))
       cPickle.dump(test_probas, open('probas_%s' % args.model_fname, 'wb'))
+  if args.export_fname:
+      model.export_params(args.export_fname)
 
 if __name__ == '__main__':
-  main()
+  # run from the importable module, so that --save_model pickles main.Model
+  # rather than __main__.Model, which other scripts could not unpickle
+  import main
+  main.main()
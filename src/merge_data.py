@@ -2,28 +2,31 @@ import argparse
 import cPickle
 import gzip
 import numpy as np
+import packed_data
 import random
 import sys
 from collections import Counter
+from index_cache import IndexCache, OOV_TOKEN, UNK_TOKEN, oov_bucket_ids, word_index
 from twokenize import tokenize
 np.random.seed(42)
 
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--suffix', type=str, default='', help='Suffix')
 parser.add_argument('--input_dir', type=str, default='../data', help='Input directory')
 parser.add_argument('--output_dir', type=str, default='.', help='Output directory')
-args = parser.parse_args()
-
-TRAIN_FILE = '%s/trainset%s.csv.pkl' % (args.input_dir, args.suffix)
-
-VAL_FILE = '%s/valset.csv.pkl' % args.input_dir
-TEST_FILE = '%s/testset.csv.pkl' % args.input_dir
+parser.add_argument('--W_dtype', type=str, default='float32', help='Storage dtype of W and W2: float16, float32 or float64')
+parser.add_argument('--sort_vocab', type=str2bool, default=False, help='Assign word ids by decreasing document frequency')
+parser.add_argument('--max_vocab', type=int, default=0, help='With --sort_vocab, keep only this many words (0 for all)')
+parser.add_argument('--n_oov_buckets', type=int, default=0, help='With --sort_vocab, num hashed buckets for words outside the vocabulary')
+parser.add_argument('--group_contexts', type=str2bool, default=False, help='Pickle val/test contexts once each as packed_data.GroupedSequences (read-only, and unpickling needs packed_data); packed_data.py groups them regardless')
+parser.add_argument('--cache_size', type=int, default=1000000, help='Max sentences in the tokenization cache')
 
 W2V_FILE = '../embeddings/word2vec/GoogleNews-vectors-negative300.bin'
 GLOVE_FILE = '../embeddings/glove/glove.840B.300d.txt'
 
-UNK_TOKEN='**unknown**'
-BATCH_SIZE = 256
 
 def uniform_sample(a, b, k=0):
     if k == 0:
@@ -33,21 +36,48 @@ def uniform_sample(a, b, k=0):
         ret[x] = random.uniform(a, b)
     return ret
 
-def get_W(word_vecs, k):
+def get_W(word_vecs, k, dtype='float32', words=None):
     """
-    Get word matrix. W[i] is the vector for word indexed by i
+    Get word matrix. W[i] is the vector for word indexed by i. Ids follow the
+    order of words if given, otherwise the iteration order of word_vecs.
     """
-    vocab_size = len(word_vecs)
+    if words is None:
+        words = list(word_vecs)
     word_idx_map = dict()
-    W = np.zeros(shape=(vocab_size+1, k))            
+    W = np.zeros(shape=(len(words)+1, k), dtype=dtype)
     W[0] = np.zeros(k)
     i = 1
-    for word in word_vecs:
+    for word in words:
         W[i] = word_vecs[word]
         word_idx_map[word] = i
         i += 1
     return W, word_idx_map
 
+def rank_words(word_vecs, vocab, max_vocab=0, n_oov_buckets=0, k=300, unk_token='**unknown**', min_df=1):
+    """
+    Orders the words of word_vecs, plus the words of vocab occurring in at
+    least min_df documents, by document frequency (most frequent first),
+    keeps the top max_vocab of them if max_vocab > 0, and appends unk_token
+    and n_oov_buckets hashed OOV bucket tokens. Random vectors, as in
+    add_unknown_words, are only drawn for the words kept and the special
+    tokens, and the vectors of words past the cap are dropped from word_vecs.
+    Those words fall into the buckets at indexing time.
+    """
+    specials = [unk_token] + [OOV_TOKEN % i for i in xrange(n_oov_buckets)]
+    candidates = set(word_vecs)
+    candidates.update(w for w, n in vocab.iteritems() if n >= min_df)
+    candidates.difference_update(specials)
+    words = sorted(candidates, key=lambda w: (-vocab.get(w, 0), w))
+    del candidates
+    if max_vocab > 0:
+        for word in words[max_vocab:]:
+            word_vecs.pop(word, None)
+        words = words[:max_vocab]
+    for word in words + specials:
+        if word not in word_vecs:
+            word_vecs[word] = uniform_sample(-0.25,0.25,k)
+    return words + specials
+
 def load_bin_vec(fname, vocab):
     """
     Loads 300x1 word vecs from Google (Mikolov) word2vec
@@ -95,41 +125,41 @@ def add_unknown_words(word_vecs, vocab, min_df=1, k=300, unk_token='**unknown**'
             word_vecs[word] = uniform_sample(-0.25,0.25,k)  
     word_vecs[unk_token] = uniform_sample(-0.25,0.25,k)
 
-def get_idx_from_sent(sent, word_idx_map, k):
+def get_idx_from_sent(sent, word_idx_map, k, bucket_ids=None):
     """
-    Transforms sentence into a list of indices. Pad with zeroes.
+    Transforms sentence into a list of indices. Pad with zeroes. Unknown
+    words map to their hashed OOV bucket if bucket_ids is given.
     """
     x = []
     words = tokenize(sent)
     for word in words:
         if word in word_idx_map:
             x.append(word_idx_map[word])
+        elif bucket_ids:
+            x.append(word_index(word, word_idx_map, None, bucket_ids))
         else:
             x.append(word_idx_map[UNK_TOKEN])
     return x
 
-def make_idx_data(dataset, word_idx_map, k=300):
+def make_idx_data(dataset, word_idx_map, k=300, cache=None):
     """
-    Transforms sentences into a 2-d matrix.
+    Transforms sentences into a 2-d matrix. If cache is given, repeated
+    sentences are looked up in it instead of being re-tokenized.
     """
+    if cache is None:
+        bucket_ids = oov_bucket_ids(word_idx_map)
+        to_idx = lambda sent: get_idx_from_sent(sent, word_idx_map, k, bucket_ids)
+    else:
+        to_idx = cache
     for i in xrange(len(dataset['y'])):
-        dataset['c'][i] = get_idx_from_sent(dataset['c'][i], word_idx_map, k)
-        dataset['r'][i] = get_idx_from_sent(dataset['r'][i], word_idx_map, k)
-
-def pad_to_batch_size(X, batch_size):
-    n_seqs = len(X)
-    n_batches_out = np.ceil(float(n_seqs) / batch_size)
-    n_seqs_out = batch_size * n_batches_out
-
-    to_pad = n_seqs % batch_size
-    if to_pad > 0:
-        X += X[:batch_size-to_pad]
-    return X
+        dataset['c'][i] = to_idx(dataset['c'][i])
+        dataset['r'][i] = to_idx(dataset['r'][i])
 
 def main():
-    train_data, train_vocab = cPickle.load(open(TRAIN_FILE))
-    val_data, val_vocab = cPickle.load(open(VAL_FILE))
-    test_data, test_vocab = cPickle.load(open(TEST_FILE))
+    args = parser.parse_args()
+    train_data, train_vocab = cPickle.load(open('%s/trainset%s.csv.pkl' % (args.input_dir, args.suffix)))
+    val_data, val_vocab = cPickle.load(open('%s/valset.csv.pkl' % args.input_dir))
+    test_data, test_vocab = cPickle.load(open('%s/testset.csv.pkl' % args.input_dir))
 
     vocab = train_vocab + val_vocab + test_vocab
     del train_vocab, val_vocab, test_vocab
@@ -147,17 +177,26 @@ def main():
     print "embeddings loaded!"
     print "num words with embeddings: ", len(embeddings)
 
-    add_unknown_words(embeddings, vocab, min_df=2)
-    W, word_idx_map = get_W(embeddings, k=300)
+    if args.sort_vocab:
+        # the cap applies before random vectors are drawn for unknown words
+        words = rank_words(embeddings, vocab, args.max_vocab, args.n_oov_buckets, k=300, unk_token=UNK_TOKEN, min_df=2)
+    else:
+        add_unknown_words(embeddings, vocab, min_df=2)
+        words = None
+    W, word_idx_map = get_W(embeddings, k=300, dtype=args.W_dtype, words=words)
     print "W: ", W.shape
 
-    for key in ['c', 'r', 'y']:
-        for dataset in [train_data, val_data]:
-            dataset[key] = pad_to_batch_size(dataset[key], BATCH_SIZE)
+    cache = IndexCache(word_idx_map, UNK_TOKEN, maxsize=args.cache_size)
+    make_idx_data(train_data, word_idx_map, cache=cache)
+    make_idx_data(val_data, word_idx_map, cache=cache)
+    make_idx_data(test_data, word_idx_map, cache=cache)
+    print "index cache: ", cache
+    del cache
 
-    make_idx_data(train_data, word_idx_map)
-    make_idx_data(val_data, word_idx_map)
-    make_idx_data(test_data, word_idx_map)
+    if args.group_contexts:
+        for dataset in [val_data, test_data]:
+            packed_data.group_contexts(dataset)
+            print "unique contexts: ", len(dataset['c'].seqs)
 
     for key in ['c', 'r', 'y']:
         print key
@@ -171,8 +210,13 @@ def main():
     del W
 
     rand_vecs = {}
-    add_unknown_words(rand_vecs, vocab, min_df=2)
-    W2, _ = get_W(rand_vecs, k=300)
+    if args.sort_vocab:
+        # same ids as W, so W2 can be swapped in for it
+        for word in words:
+            rand_vecs[word] = uniform_sample(-0.25,0.25,300)
+    else:
+        add_unknown_words(rand_vecs, vocab, min_df=2)
+    W2, _ = get_W(rand_vecs, k=300, dtype=args.W_dtype, words=words)
     print "W2: ", W2.shape
     cPickle.dump([W2, word_idx_map], open("%s/W2%s.pkl" % (args.output_dir, args.suffix), "wb"), protocol=-1)
     del W2
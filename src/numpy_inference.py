@@ -0,0 +1,254 @@
+from __future__ import division
+import argparse
+import cPickle
+import json
+import numpy as np
+import time
+import truncation
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+class RecurrentLayer:
+    """
+    Forward pass of an exported lasagne RecurrentLayer, LSTMLayer (with
+    peepholes) or GRULayer. Masked steps carry the previous state over, as in
+    lasagne, and outputs of backwards layers are returned in input order.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.backwards = bool(params.pop('backwards'))
+        if 'W_in_to_ingate' in params:
+            self.kind = 'lstm'
+            self.gates = ['ingate', 'forgetgate', 'cell', 'outgate']
+        elif 'W_in_to_resetgate' in params:
+            self.kind = 'gru'
+            self.gates = ['resetgate', 'updategate', 'hidden_update']
+        else:
+            self.kind = 'rnn'
+            self.gates = ['hid']
+        if self.kind == 'rnn':
+            self.W_in = params['W_in_to_hid']
+            self.b = params['b']
+            self.W_hid = params['W_hid_to_hid']
+        else:
+            # stack gates so the input and hidden projections are one dot each
+            self.W_in = np.concatenate([params['W_in_to_%s' % g] for g in self.gates], axis=1)
+            self.b = np.concatenate([params['b_%s' % g] for g in self.gates])
+            self.W_hid = np.concatenate([params['W_hid_to_%s' % g] for g in self.gates], axis=1)
+        self.num_units = self.W_hid.shape[0]
+
+    def __call__(self, X, mask):
+        n, T, _ = X.shape
+        H = self.num_units
+        X_in = X.reshape((n*T, -1)).dot(self.W_in).reshape((n, T, -1)) + self.b
+        h = np.repeat(self.params['hid_init'].reshape((1, H)), n, axis=0)
+        if self.kind == 'lstm':
+            c = np.repeat(self.params['cell_init'].reshape((1, H)), n, axis=0)
+            p = self.params
+        out = np.empty((n, T, H), dtype=X.dtype)
+        steps = xrange(T-1, -1, -1) if self.backwards else xrange(T)
+        for t in steps:
+            x_t = X_in[:, t]
+            m = mask[:, t:t+1]
+            if self.kind == 'rnn':
+                h_new = np.tanh(x_t + h.dot(self.W_hid))
+            elif self.kind == 'lstm':
+                g = x_t + h.dot(self.W_hid)
+                i = sigmoid(g[:, :H] + c*p['W_cell_to_ingate'])
+                f = sigmoid(g[:, H:2*H] + c*p['W_cell_to_forgetgate'])
+                c_new = f*c + i*np.tanh(g[:, 2*H:3*H])
+                o = sigmoid(g[:, 3*H:] + c_new*p['W_cell_to_outgate'])
+                h_new = o*np.tanh(c_new)
+                c = np.where(m, c_new, c)
+            else:
+                g = h.dot(self.W_hid)
+                r = sigmoid(x_t[:, :H] + g[:, :H])
+                u = sigmoid(x_t[:, H:2*H] + g[:, H:2*H])
+                h_update = np.tanh(x_t[:, 2*H:] + r*g[:, 2*H:])
+                h_new = (1-u)*h + u*h_update
+            h = np.where(m, h_new, h)
+            out[:, t] = h
+        return out
+
+class InferenceEngine:
+    """
+    Pure-NumPy dual encoder loaded from a file written by Model.export_params.
+    Works on any batch size and does not import Theano or Lasagne. The
+    embedding matrix can be kept in a compact emb_dtype (e.g. float16), in
+    which case the rows of each batch are upcast to dtype after the lookup.
+    """
+    def __init__(self, fname, dtype=np.float32, emb_dtype=None):
+        f = np.load(fname)
+        self.config = json.loads(str(f['config']))
+        self.dtype = dtype
+        arrays = dict((key, f[key].astype(dtype) if f[key].dtype.kind == 'f' else f[key]) for key in f.files if key not in ['config', 'embeddings'])
+        self.embeddings = f['embeddings'].astype(emb_dtype or dtype)
+        self.M = arrays['M']
+        if self.config['use_ntn']:
+            self.U, self.V, self.b = arrays['U'], arrays['V'], arrays['b']
+        directions = ['fwd', 'bck'] if self.config['is_bidirectional'] else ['fwd']
+        self.layers = []
+        for direction in directions:
+            layers = []
+            for i in xrange(self.config['n_recurrent_layers']):
+                prefix = '%s_%d_' % (direction, i)
+                layers.append(RecurrentLayer(dict((key[len(prefix):], value) for key, value in arrays.iteritems()
+                                                  if key.startswith(prefix))))
+            self.layers.append(layers)
+        self.max_seqlen = self.config['max_seqlen']
+        self.truncate = self.config.get('truncate', 'head')
+        self.max_turns = self.config.get('max_turns', 0)
+        self.max_turn_len = self.config.get('max_turn_len', 0)
+        self.eot_ids = self.config.get('eot_ids', [])
+
+    def get_batch(self, seqs, strategy='head'):
+        """
+        Same truncation and padding as Model.get_batch, but sized to the
+        number of sequences and to the longest one.
+        """
+        seqs = [truncation.truncate(row, self.max_seqlen, strategy, self.eot_ids, self.max_turns, self.max_turn_len)
+                for row in seqs]
+        max_l = max(1, max(len(row) for row in seqs))
+        batch = np.zeros((len(seqs), max_l), dtype=np.int32)
+        mask = np.zeros((len(seqs), max_l), dtype=self.dtype)
+        seqlen = np.zeros((len(seqs),), dtype=np.int32)
+        for i, row in enumerate(seqs):
+            batch[i, :len(row)] = row
+            mask[i, :len(row)] = 1
+            seqlen[i] = len(row)-1
+        return batch, seqlen, mask
+
+    def encode(self, seqs, key='r'):
+        """
+        Encodes contexts (key='c', truncated with the model's strategy) or
+        responses (key='r').
+        """
+        batch, seqlen, mask = self.get_batch(seqs, self.truncate if key == 'c' else 'head')
+        X = self.embeddings[batch].astype(self.dtype, copy=False)
+        outputs = []
+        for layers in self.layers:
+            h = X
+            for layer in layers:
+                h = layer(h, mask)
+            outputs.append(h)
+        h = np.concatenate(outputs, axis=2) if len(outputs) > 1 else outputs[0]
+        return h[np.arange(len(seqs)), seqlen]
+
+    def score(self, e_context, e_response):
+        if self.config['use_ntn']:
+            k = self.config['k']
+            dp = np.concatenate([np.sum(e_context * e_response.dot(self.M[i]), axis=1, keepdims=True) for i in xrange(k)], axis=1)
+            dp += np.concatenate([e_context, e_response], axis=1).dot(self.V.T) + self.b
+            dp = np.tanh(dp).dot(self.U)
+        else:
+            dp = np.sum(e_context * e_response.dot(self.M.T), axis=1)
+        return np.clip(sigmoid(dp), 1e-7, 1.0-1e-7)
+
+    def predict(self, contexts, responses, batch_size=256):
+        """
+        Probability that each response follows its context.
+        """
+        probas = []
+        for i in xrange(0, len(contexts), batch_size):
+            probas.append(self.score(self.encode(contexts[i:i+batch_size], 'c'), self.encode(responses[i:i+batch_size], 'r')))
+        return np.concatenate(probas)
+
+def recall_at_k(probas, k, group_size=10, test_size=10):
+    """
+    Fraction of groups whose true response (always first) is in the top k of
+    the first group_size candidates, as in Model.recall.
+    """
+    n_groups = len(probas) // test_size
+    P = np.asarray(probas[:n_groups*test_size]).reshape((n_groups, test_size))[:, :group_size]
+    return np.mean((P[:, 1:] > P[:, :1]).sum(axis=1) < k)
+
+def compare_dtypes(fname, dataset, emb_dtype, n_examples, batch_size=256):
+    """
+    Reports recall@k on dataset with embeddings kept in full precision and in
+    emb_dtype, and the host memory taken by the embedding matrix in each case.
+    """
+    n_examples -= n_examples % 10
+    results = {}
+    for dtype in [None, emb_dtype]:
+        engine = InferenceEngine(fname, emb_dtype=dtype)
+        probas = engine.predict(dataset['c'][:n_examples], dataset['r'][:n_examples], batch_size)
+        name = np.dtype(dtype or engine.dtype).name
+        results[name] = dict(('r%d@%d' % (k, g), recall_at_k(probas, k, g)) for g, k in [(2, 1), (10, 1), (10, 2), (10, 5)])
+        results[name]['embeddings_mb'] = engine.embeddings.nbytes / 2.**20
+    for name, res in sorted(results.iteritems()):
+        print name, ', '.join('%s: %.4f' % (key, value) for key, value in sorted(res.iteritems()))
+    return results
+
+def compare_truncation(engine, dataset, max_seqlens, strategies, n_examples, batch_size=256):
+    """
+    Reports recall@k and scoring time on dataset for every combination of
+    context max_seqlen and truncation strategy.
+    """
+    n_examples -= n_examples % 10
+    saved = engine.max_seqlen, engine.truncate
+    results = {}
+    for strategy in strategies:
+        for max_seqlen in max_seqlens:
+            engine.max_seqlen, engine.truncate = max_seqlen, strategy
+            start_time = time.time()
+            probas = engine.predict(dataset['c'][:n_examples], dataset['r'][:n_examples], batch_size)
+            res = dict(('r%d@%d' % (k, g), recall_at_k(probas, k, g)) for g, k in [(2, 1), (10, 1), (10, 2), (10, 5)])
+            res['time'] = time.time() - start_time
+            results[(strategy, max_seqlen)] = res
+            print '%s max_seqlen=%d' % (strategy, max_seqlen), ', '.join('%s: %.4f' % (key, value) for key, value in sorted(res.iteritems()))
+    engine.max_seqlen, engine.truncate = saved
+    return results
+
+def check_parity(model, engine, dataset, n_batches=10, atol=1e-4):
+    """
+    Compares engine.predict against model.compute_probas on the first
+    n_batches batches of dataset. Returns the max absolute difference.
+    """
+    n = n_batches * model.batch_size
+    expected = np.concatenate([model.compute_probas(dataset, i) for i in xrange(n_batches)])
+    actual = engine.predict(dataset['c'][:n], dataset['r'][:n])
+    diff = np.abs(expected - actual).max()
+    print 'parity: max abs diff %g over %d examples (%s)' % (diff, n, 'ok' if diff <= atol else 'MISMATCH')
+    return diff
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params_fname', type=str, default='model.npz', help='File written by Model.export_params')
+    parser.add_argument('--dataset_fname', type=str, default='dataset.pkl', help='Dataset filename')
+    parser.add_argument('--model_fname', type=str, default='', help='Model saved by main.py --save_model to check parity against (needs main.py importable)')
+    parser.add_argument('--batch_size', type=int, default=256, help='Batch size')
+    parser.add_argument('--n_examples', type=int, default=10000, help='Num test examples to score')
+    parser.add_argument('--compare_max_seqlens', type=str, default='', help='Comma-separated context lengths at which to report recall@k, e.g. 20,40,80,160')
+    parser.add_argument('--compare_truncate', type=str, default='head,tail', help='Comma-separated truncation strategies for --compare_max_seqlens')
+    parser.add_argument('--eot_fname', type=str, default='', help='W.pkl or word_idx_map.pkl providing end-of-turn ids, if the exported model has none')
+    parser.add_argument('--compare_emb_dtype', type=str, default='', help='Report recall@k with embeddings stored in this dtype (e.g. float16)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    engine = InferenceEngine(args.params_fname)
+    print 'engine loaded, took: %.3f(s)' % (time.time() - start_time)
+
+    _, _, test_data = cPickle.load(open(args.dataset_fname, 'rb'))
+    start_time = time.time()
+    probas = engine.predict(test_data['c'][:args.n_examples], test_data['r'][:args.n_examples], args.batch_size)
+    print 'scored %d examples, took: %.3f(s)' % (len(probas), time.time() - start_time)
+
+    if args.compare_emb_dtype:
+        compare_dtypes(args.params_fname, test_data, np.dtype(args.compare_emb_dtype), args.n_examples, args.batch_size)
+
+    if args.compare_max_seqlens:
+        if args.eot_fname:
+            word_idx_map = cPickle.load(open(args.eot_fname, 'rb'))
+            if isinstance(word_idx_map, (list, tuple)):
+                word_idx_map = word_idx_map[1]
+            engine.eot_ids = truncation.find_eot_ids(word_idx_map)
+        compare_truncation(engine, test_data, [int(l) for l in args.compare_max_seqlens.split(',')],
+                           args.compare_truncate.split(','), args.n_examples, args.batch_size)
+
+    if args.model_fname:
+        model = cPickle.load(open(args.model_fname, 'rb'))
+        check_parity(model, engine, test_data)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import cPickle
+import json
+import numpy as np
+import os
+
+SPLITS = ['train', 'val', 'test']
+
+class PackedSequences:
+    """
+    Read-only list of token sequences stored as one flat token array plus
+    offsets, both usually memory-mapped. Supports len(), integer indexing and
+    slicing (with steps), which is all Model.get_batch needs.
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.tokens[self.offsets[j]:self.offsets[j+1]] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+class GroupedSequences:
+    """
+    Read-only list view over rows that share sequences: row i is seqs[ids[i]].
+    Val and test store each context once this way rather than once per
+    candidate response.
+    """
+    def __init__(self, seqs, ids):
+        self.seqs = seqs
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.seqs[j] for j in self.ids[i]]
+        return self.seqs[self.ids[i]]
+
+    def __iter__(self):
+        for j in self.ids:
+            yield self.seqs[j]
+
+class ConcatSequences:
+    """
+    Read-only list view over several sequence lists (e.g. the shards of a
+    dataset) one after the other.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+        self.starts = np.zeros(len(parts)+1, dtype=np.int64)
+        np.cumsum([len(p) for p in parts], out=self.starts[1:])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        part = np.searchsorted(self.starts, i, side='right') - 1
+        return self.parts[part][i - self.starts[part]]
+
+    def __iter__(self):
+        for p in self.parts:
+            for s in p:
+                yield s
+
+def dedup_sequences(seqs):
+    """
+    Unique sequences in order of first appearance, and the position of each
+    row's sequence among them.
+    """
+    index = {}
+    unique = []
+    ids = np.empty(len(seqs), dtype=np.int32)
+    for i, s in enumerate(seqs):
+        key = tuple(s)
+        j = index.get(key)
+        if j is None:
+            j = index[key] = len(unique)
+            unique.append(s)
+        ids[i] = j
+    return unique, ids
+
+def group_contexts(dataset):
+    """
+    Replaces dataset['c'] by a GroupedSequences holding each context once.
+    """
+    if not isinstance(dataset['c'], GroupedSequences):
+        dataset['c'] = GroupedSequences(*dedup_sequences(dataset['c']))
+    return dataset
+
+def token_dtype(vocab_size):
+    """
+    Smallest dtype holding every token id: uint16 for vocabularies (including
+    the padding row) of up to 65536 entries, int32 otherwise.
+    """
+    return np.uint16 if vocab_size <= 2**16 else np.int32
+
+def pack_sequences(seqs, dtype=np.int32):
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.empty(offsets[-1], dtype=dtype)
+    for i, s in enumerate(seqs):
+        tokens[offsets[i]:offsets[i+1]] = s
+    return tokens, offsets
+
+def pack_dataset(datasets, out_dir, vocab_size=None, grouped_splits=('val', 'test')):
+    """
+    Writes [train, val, test] dicts of c/r/y lists as .npy arrays in out_dir.
+    Token ids are stored as uint16 when vocab_size allows it. Contexts of
+    grouped_splits are stored once each, plus a per-row context id array.
+    """
+    dtype = np.int32 if vocab_size is None else token_dtype(vocab_size)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    meta = {}
+    for split, dataset in zip(SPLITS, datasets):
+        if split in grouped_splits:
+            group_contexts(dataset)
+        if isinstance(dataset['c'], GroupedSequences):
+            np.save('%s/%s_c_ids.npy' % (out_dir, split), dataset['c'].ids)
+        for key in ['c', 'r']:
+            seqs = dataset[key].seqs if isinstance(dataset[key], GroupedSequences) else dataset[key]
+            tokens, offsets = pack_sequences(seqs, dtype)
+            np.save('%s/%s_%s_tokens.npy' % (out_dir, split, key), tokens)
+            np.save('%s/%s_%s_offsets.npy' % (out_dir, split, key), offsets)
+        np.save('%s/%s_y.npy' % (out_dir, split), np.asarray(dataset['y'], dtype=np.int32))
+        meta[split] = len(dataset['y'])
+    with open('%s/meta.json.tmp' % out_dir, 'wb') as f:
+        json.dump(meta, f)
+    os.rename('%s/meta.json.tmp' % out_dir, '%s/meta.json' % out_dir)
+
+def load_packed(in_dir, mmap_mode='r'):
+    """
+    Opens a directory written by pack_dataset. Arrays are memory-mapped, so
+    processes loading the same directory share one copy in the page cache.
+    Splits with stored context ids get a GroupedSequences as 'c'. Split sizes
+    are checked against meta.json, which pack_dataset writes last.
+    """
+    meta = json.load(open('%s/meta.json' % in_dir))
+    datasets = []
+    for split in SPLITS:
+        dataset = {}
+        for key in ['c', 'r']:
+            dataset[key] = PackedSequences(np.load('%s/%s_%s_tokens.npy' % (in_dir, split, key), mmap_mode=mmap_mode),
+                                           np.load('%s/%s_%s_offsets.npy' % (in_dir, split, key), mmap_mode=mmap_mode))
+        ids_fname = '%s/%s_c_ids.npy' % (in_dir, split)
+        if os.path.exists(ids_fname):
+            dataset['c'] = GroupedSequences(dataset['c'], np.load(ids_fname, mmap_mode=mmap_mode))
+        dataset['y'] = np.load('%s/%s_y.npy' % (in_dir, split), mmap_mode=mmap_mode)
+        if len(dataset['y']) != meta[split] or len(dataset['r']) != meta[split] or len(dataset['c']) != meta[split]:
+            raise ValueError('%s: %s split does not have the %d rows of meta.json' % (in_dir, split, meta[split]))
+        datasets.append(dataset)
+    return datasets
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_fname', type=str, default='dataset.pkl', help='Dataset filename')
+    parser.add_argument('--W_fname', type=str, default='W.pkl', help='W filename')
+    parser.add_argument('--W_dtype', type=str, default='float32', help='Storage dtype of W: float16 or float32')
+    parser.add_argument('--output_dir', type=str, default='dataset_packed', help='Output directory')
+    args = parser.parse_args()
+
+    W, word_idx_map = cPickle.load(open(args.W_fname, 'rb'))
+    datasets = cPickle.load(open(args.dataset_fname, 'rb'))
+    pack_dataset(datasets, args.output_dir, W.shape[0])
+    del datasets
+    np.save('%s/W.npy' % args.output_dir, W.astype(args.W_dtype))
+    cPickle.dump(word_idx_map, open('%s/word_idx_map.pkl' % args.output_dir, 'wb'), protocol=-1)
+    print 'packed dataset written to', args.output_dir
+    in_size = os.path.getsize(args.dataset_fname) + os.path.getsize(args.W_fname)
+    out_size = sum(os.path.getsize('%s/%s' % (args.output_dir, f)) for f in os.listdir(args.output_dir))
+    print 'size: %.1fMB -> %.1fMB' % (in_size / 2.**20, out_size / 2.**20)
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,111 @@
+import argparse
 import glob
-import sys
+import json
+import multiprocessing
+
+METRICS_PREFIX = 'metrics: '
 
 def get_value(s):
     return float(s.split()[1])
 
+def parse_legacy(fname, lines):
+    """
+    Fallback for logs written before main.py emitted JSON metrics: reads
+    values at fixed offsets around the last 'test_perf' line.
+    """
+    idx = None
+    args = None
+    for i in xrange(len(lines)):
+        if lines[i].find('test_perf') > -1:
+            idx = i
+        elif lines[i].find('encoder') > -1:
+            args = lines[i].strip()
+    return {
+        'fname': fname,
+        'args': args,
+        'val_r1@10': get_value(lines[idx-3]),
+        'test_r1@2': get_value(lines[idx+2]),
+        'test_r1@10': get_value(lines[idx+4]),
+        'test_r2@10': get_value(lines[idx+5]),
+        'test_r5@10': get_value(lines[idx+6])
+    }
+
+def summarize(fname, records):
+    """
+    Summarizes a run by its last epoch that was evaluated on test (i.e. the
+    last new best on val), or its last epoch if test was never reached.
+    Runs validating mid-epoch log several records per epoch.
+    """
+    args = None
+    best = None
+    epochs = set()
+    for record in records:
+        event = record.pop('event', None)
+        if event == 'args':
+            args = record
+        elif event == 'epoch':
+            epochs.add(record.get('epoch'))
+            if best is None or 'test_perf' in record or 'test_perf' not in best:
+                best = record
+    if best is None:
+        return None
+    result = dict(best)
+    result.update({ 'fname': fname, 'args': args, 'n_epochs': len(epochs) })
+    return result
+
 def process_file(fname):
     try:
-        lines = [l for l in open(fname)]
-        idx = None
-        args = None
-        for i in xrange(len(lines)):
-            if lines[i].find('test_perf') > -1:
-                idx = i
-            elif lines[i].find('encoder') > -1:
-                args = lines[i]
-        return {
-            'fname': fname,
-            'args': args,
-            'val_r1@10': get_value(lines[idx-3]),
-            'test_r1@2': get_value(lines[idx+2]),
-            'test_r1@10': get_value(lines[idx+4]),
-            'test_r2@10': get_value(lines[idx+5]),
-            'test_r5@10': get_value(lines[idx+6])
-        }
-    except:
-        print 'Error reading:', fname
-        return None
+        with open(fname) as f:
+            lines = f.readlines()
+        records = [json.loads(l[len(METRICS_PREFIX):]) for l in lines if l.startswith(METRICS_PREFIX)]
+        if records:
+            return summarize(fname, records)
+        return parse_legacy(fname, lines)
+    except Exception as e:
+        return { 'fname': fname, 'error': '%s: %s' % (type(e).__name__, e) }
+
+def process_files(fnames, n_workers):
+    if n_workers == 1:
+        return map(process_file, fnames)
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        return list(pool.imap_unordered(process_file, fnames, chunksize=max(1, len(fnames) // (4*n_workers))))
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('patterns', nargs='+', help='Glob patterns of log files')
+    parser.add_argument('--metric', type=str, default='val_r1@10', help='Metric to rank runs by')
+    parser.add_argument('--ascending', action='store_true', help='Rank lower values first')
+    parser.add_argument('--top', type=int, default=10, help='Number of runs to print (0 for all)')
+    parser.add_argument('--columns', type=str, default='val_r1@10,test_r1@2,test_r1@10,test_r2@10,test_r5@10', help='Comma-separated metrics to print')
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count(), help='Num parser processes')
+    args = parser.parse_args()
+
+    fnames = sorted(set(f for pattern in args.patterns for f in glob.glob(pattern)))
+    print 'num files:', len(fnames)
+    results = process_files(fnames, max(1, min(args.n_workers, len(fnames))))
+
+    errors = [r for r in results if r is not None and 'error' in r]
+    for r in errors:
+        print 'Error reading:', r['fname'], r['error']
+    results = [r for r in results if r is not None and 'error' not in r]
+    missing = [r for r in results if args.metric not in r]
+    if missing:
+        print 'no %s in %d files' % (args.metric, len(missing))
+    results = [r for r in results if args.metric in r]
+    results.sort(key=lambda r: r[args.metric], reverse=not args.ascending)
+    if args.top > 0:
+        results = results[:args.top]
+
+    columns = [args.metric] + [c for c in args.columns.split(',') if c and c != args.metric]
+    print '\t'.join(columns + ['fname'])
+    for r in results:
+        print '\t'.join(['%.4f' % r[c] if c in r else '-' for c in columns] + [r['fname']])
+    if results:
+        print 'best:', results[0]
 
-pattern = sys.argv[1]
-print 'pattern:', pattern
-fnames = glob.glob(pattern)
-print 'fnames:', fnames
-best_result = None
-for fname in fnames:
-    curr_result = process_file(fname)
-    if not curr_result:
-        continue
-    if best_result is None or best_result['val_r1@10'] < curr_result['val_r1@10']:
-        best_result = curr_result
-print best_result
+if __name__ == '__main__':
+    main()
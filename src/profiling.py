@@ -0,0 +1,118 @@
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, from /proc where available,
+    otherwise the peak RSS reported by getrusage.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.time()
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, time.time() - self.start_time)
+
+class NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+class Profiler:
+    """
+    Named timers and counters, plus periodic samples of process RSS and of
+    the memory held by shared variables. report() prints the totals since the
+    last report and optionally appends them as a JSON line to fname.
+    """
+    enabled = True
+
+    def __init__(self, fname='', sample_every=100):
+        self.fname = fname
+        self.sample_every = sample_every
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.calls = OrderedDict()
+        self.counters = OrderedDict()
+        self.max_rss = 0
+        self.max_shared_bytes = 0
+        self.n_steps = 0
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add_time(self, name, t):
+        self.times[name] = self.times.get(name, 0.) + t
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def step(self, shared_bytes_fn=None):
+        """
+        Called once per training step; samples memory every sample_every steps.
+        """
+        self.n_steps += 1
+        if self.n_steps % self.sample_every == 1 or self.sample_every == 1:
+            self.sample_memory(shared_bytes_fn)
+
+    def sample_memory(self, shared_bytes_fn=None):
+        self.max_rss = max(self.max_rss, current_rss())
+        if shared_bytes_fn is not None:
+            self.max_shared_bytes = max(self.max_shared_bytes, shared_bytes_fn())
+
+    def report(self, **extra):
+        record = OrderedDict(extra)
+        record['times'] = self.times
+        record['calls'] = self.calls
+        record['counters'] = self.counters
+        record['max_rss_mb'] = self.max_rss / 2.**20
+        record['max_shared_mb'] = self.max_shared_bytes / 2.**20
+        print 'profile:', ', '.join('%s %.2f(s)/%d' % (name, t, self.calls[name]) for name, t in self.times.iteritems()), \
+              '|', ', '.join('%s %d' % item for item in self.counters.iteritems()), \
+              '| rss %.1fMB, shared %.1fMB' % (record['max_rss_mb'], record['max_shared_mb'])
+        if self.fname:
+            with open(self.fname, 'ab') as f:
+                f.write(json.dumps(record) + '\n')
+        self.reset()
+
+class NullProfiler:
+    """
+    Stand-in used when profiling is off: every call is a no-op.
+    """
+    enabled = False
+    _timer = NullTimer()
+
+    def timer(self, name):
+        return self._timer
+
+    def add_time(self, name, t):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def step(self, shared_bytes_fn=None):
+        pass
+
+    def sample_memory(self, shared_bytes_fn=None):
+        pass
+
+    def report(self, **extra):
+        pass
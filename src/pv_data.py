@@ -0,0 +1,82 @@
+import argparse
+import cPickle
+import numpy as np
+import os
+import packed_data
+
+def count_lines(fname):
+    with open(fname, 'rb') as f:
+        return sum(1 for _ in f)
+
+def convert_pv_vecs(txt_fname, out_fname, ndims, dtype=np.float32, chunk_size=100000):
+    """
+    Converts a text file of '<label> <v_1> ... <v_ndims>' lines into an .npy
+    matrix, parsing chunk_size lines at a time straight into a memmap. Row 0
+    is left as zeros for padding, so line i of the file becomes row i+1. The
+    file only appears under out_fname once complete.
+    """
+    tmp_fname = out_fname + '.partial'
+    X = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=(count_lines(txt_fname)+1, ndims))
+    offset = 1
+    rows = []
+    with open(txt_fname, 'rb') as f:
+        for line in f:
+            rows.append(line.split(None, 1)[1])
+            if len(rows) == chunk_size:
+                X[offset:offset+len(rows)] = np.fromstring(' '.join(rows), dtype=dtype, sep=' ').reshape((-1, ndims))
+                offset += len(rows)
+                rows = []
+    if rows:
+        X[offset:offset+len(rows)] = np.fromstring(' '.join(rows), dtype=dtype, sep=' ').reshape((-1, ndims))
+    shape = X.shape
+    X.flush()
+    del X
+    os.rename(tmp_fname, out_fname)
+    return shape
+
+def split_pv_data(data, n_train, n_val):
+    """
+    Splits the all_pv.pkl dict into train, val and test at the given sizes.
+    """
+    bounds = [(0, n_train), (n_train, n_train+n_val), (n_train+n_val, len(data['y']))]
+    return [dict((key, data[key][lo:hi]) for key in ['c', 'r', 'y']) for lo, hi in bounds]
+
+def convert_pv(data_fname, vecs_fname, out_dir, ndims, n_train=1000000, n_val=356080):
+    """
+    One-time conversion of the paragraph-vector inputs of --use_pv into a
+    packed dataset directory, whose meta.json records the split sizes, plus
+    the vectors as pv_vectors_<ndims>d.npy. meta.json is written last, so its
+    presence marks a finished conversion.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    vecs_out = '%s/pv_vectors_%dd.npy' % (out_dir, ndims)
+    nrows, _ = convert_pv_vecs(vecs_fname, vecs_out, ndims)
+    data = cPickle.load(open(data_fname, 'rb'))
+    packed_data.pack_dataset(split_pv_data(data, n_train, n_val), out_dir, nrows)
+
+def load_pv(pv_dir, ndims, mmap_mode='r'):
+    """
+    Opens a directory written by convert_pv. Returns the train, val and test
+    sets and the vectors, all memory-mapped.
+    """
+    train_data, val_data, test_data = packed_data.load_packed(pv_dir, mmap_mode)
+    W = np.load('%s/pv_vectors_%dd.npy' % (pv_dir, ndims), mmap_mode=mmap_mode)
+    return train_data, val_data, test_data, W
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_fname', type=str, default='../data/all_pv.pkl', help='Pickled PV dataset')
+    parser.add_argument('--vecs_fname', type=str, default='', help='PV vectors text file (default: ../data/pv_vectors_<ndims>d.txt)')
+    parser.add_argument('--pv_ndims', type=int, default=100, help='PV ndims')
+    parser.add_argument('--n_train', type=int, default=1000000, help='Num train examples at the start of the dataset')
+    parser.add_argument('--n_val', type=int, default=356080, help='Num val examples following them')
+    parser.add_argument('--output_dir', type=str, default='../data/pv_packed', help='Output directory')
+    args = parser.parse_args()
+
+    vecs_fname = args.vecs_fname or '../data/pv_vectors_%dd.txt' % args.pv_ndims
+    convert_pv(args.data_fname, vecs_fname, args.output_dir, args.pv_ndims, args.n_train, args.n_val)
+    print 'PV data written to', args.output_dir
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+from __future__ import division
+import argparse
+import cPickle
+import numpy as np
+import time
+
+class ResponseIndex(object):
+    """
+    Precomputed encodings of a pool of candidate responses, scored against
+    new contexts with one matrix multiply through M and an argpartition top-k.
+
+    For the bilinear scorer, score(c, r) = c^T M r, so a batch of contexts C is
+    projected once (C M) and multiplied by the pool matrix. The NTN scorer is
+    supported in 'exact' mode by precomputing the response half of its V term.
+    Sigmoid is monotonic, so ranking is done on the raw scores.
+    """
+    def __init__(self, E, M, quantize=False, ntn_params=None):
+        E = np.ascontiguousarray(E, dtype=np.float32)
+        self.M = np.asarray(M, dtype=np.float32)
+        self.ntn_params = ntn_params
+        self.quantize = quantize
+        if quantize:
+            # symmetric per-row int8 quantization: E ~= scale[:, None] * E_q
+            self.scale = np.abs(E).max(axis=1) / 127.
+            self.scale[self.scale == 0] = 1.
+            self.E = np.round(E / self.scale[:, None]).astype(np.int8)
+            self.scale = self.scale.astype(np.float32)
+        else:
+            self.scale = None
+            self.E = E
+        if ntn_params is not None:
+            h = E.shape[1]
+            self.r_term = E.dot(ntn_params['V'][:, h:].T).astype(np.float32)
+        self.centroids = None
+        self.lists = None
+
+    def __len__(self):
+        return self.E.shape[0]
+
+    @classmethod
+    def from_model(cls, model, responses, quantize=False):
+        """
+        Encodes responses (lists of word indices) with a trained Model.
+        """
+        if model.eval_fns is None:
+            model.compile_eval_fns()
+        E = model.compute_encodings(responses, 'r')
+        ntn_params = None
+        if model.use_ntn:
+            ntn_params = dict((name, getattr(model, name).get_value()) for name in ['U', 'V', 'b'])
+        return cls(E, model.M.get_value(), quantize=quantize, ntn_params=ntn_params)
+
+    def matmul(self, Q, rows=None, block_size=65536):
+        """
+        Q (n_q, h) times the pool matrix (or the given rows of it), transposed.
+        An int8 pool is dequantized block_size rows at a time.
+        """
+        E = self.E if rows is None else self.E[rows]
+        if not self.quantize:
+            return Q.dot(E.T)
+        scale = self.scale if rows is None else self.scale[rows]
+        S = np.empty((len(Q), len(E)), dtype=np.float32)
+        for i in xrange(0, len(E), block_size):
+            S[:, i:i+block_size] = Q.dot(E[i:i+block_size].T.astype(np.float32)) * scale[i:i+block_size]
+        return S
+
+    def scores(self, C):
+        C = np.atleast_2d(np.asarray(C, dtype=np.float32))
+        if self.ntn_params is None:
+            return self.matmul(C.dot(self.M))
+        U, V, b = self.ntn_params['U'], self.ntn_params['V'], self.ntn_params['b']
+        h = C.shape[1]
+        S = np.zeros((C.shape[0], len(self)), dtype=np.float32)
+        c_term = C.dot(V[:, :h].T) + b
+        for i in xrange(len(U)):
+            S += U[i] * np.tanh(self.matmul(C.dot(self.M[i].T)) + c_term[:, i:i+1] + self.r_term[:, i])
+        return S
+
+    def build_partitions(self, n_lists=256, n_iter=10, sample_size=100000, seed=42):
+        """
+        Clusters the pool into n_lists partitions with a few rounds of k-means
+        on a sample, for the 'partitioned' search mode.
+        """
+        if self.ntn_params is not None:
+            raise ValueError('partitioned search is only supported with the bilinear scorer')
+        rng = np.random.RandomState(seed)
+        E = self.E.astype(np.float32)
+        if self.quantize:
+            E *= self.scale[:, None]
+        sample = E[rng.choice(len(E), min(sample_size, len(E)), replace=False)]
+        n_lists = min(n_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in xrange(n_iter):
+            assign = self.nearest(sample, centroids)
+            for j in xrange(n_lists):
+                members = sample[assign == j]
+                if len(members) > 0:
+                    centroids[j] = members.mean(axis=0)
+        assign = self.nearest(E, centroids)
+        order = np.argsort(assign, kind='mergesort')
+        bounds = np.searchsorted(assign[order], np.arange(n_lists+1))
+        self.centroids = centroids
+        self.lists = [order[bounds[j]:bounds[j+1]] for j in xrange(n_lists)]
+
+    @staticmethod
+    def nearest(X, centroids, chunk_size=65536):
+        c_sqnorm = (centroids ** 2).sum(axis=1)
+        assign = np.empty(len(X), dtype=np.int64)
+        for i in xrange(0, len(X), chunk_size):
+            assign[i:i+chunk_size] = np.argmin(c_sqnorm - 2 * X[i:i+chunk_size].dot(centroids.T), axis=1)
+        return assign
+
+    def search(self, C, k=10, mode='exact', n_probe=8):
+        """
+        Returns (indices, scores) of the top k pool responses for each context
+        encoding in C, best first.
+        """
+        C = np.atleast_2d(np.asarray(C, dtype=np.float32))
+        if mode == 'exact':
+            S = self.scores(C)
+            return top_k(S, k)
+        elif mode == 'partitioned':
+            if self.centroids is None:
+                self.build_partitions()
+            Q = C.dot(self.M)
+            probes = top_k(Q.dot(self.centroids.T), min(n_probe, len(self.centroids)))[0]
+            indices = np.empty((len(C), k), dtype=np.int64)
+            scores = np.empty((len(C), k), dtype=np.float32)
+            for i in xrange(len(C)):
+                rows = np.concatenate([self.lists[j] for j in probes[i]])
+                if len(rows) < k:
+                    rows = np.arange(len(self))
+                idx, s = top_k(self.matmul(Q[i:i+1], rows), k)
+                indices[i], scores[i] = rows[idx[0]], s[0]
+            return indices, scores
+        raise ValueError('Unsupported search mode: %s' % mode)
+
+    def save(self, prefix):
+        np.save('%s_E.npy' % prefix, self.E)
+        params = { 'M': self.M, 'scale': self.scale, 'quantize': self.quantize, 'ntn_params': self.ntn_params,
+                   'centroids': self.centroids, 'lists': self.lists }
+        cPickle.dump(params, open('%s_params.pkl' % prefix, 'wb'), protocol=-1)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        params = cPickle.load(open('%s_params.pkl' % prefix, 'rb'))
+        index = cls.__new__(cls)
+        index.E = np.load('%s_E.npy' % prefix, mmap_mode=mmap_mode)
+        for key, value in params.iteritems():
+            setattr(index, key, value)
+        if index.ntn_params is not None:
+            E = index.E.astype(np.float32)
+            if index.quantize:
+                E *= index.scale[:, None]
+            index.r_term = E.dot(index.ntn_params['V'][:, E.shape[1]:].T).astype(np.float32)
+        return index
+
+def top_k(S, k):
+    """
+    Row-wise top k of S via argpartition, sorted best first.
+    """
+    k = min(k, S.shape[1])
+    rows = np.arange(len(S))[:, None]
+    idx = np.argpartition(-S, k-1, axis=1)[:, :k]
+    s = S[rows, idx]
+    order = np.argsort(-s, axis=1)
+    return idx[rows, order], s[rows, order]
+
+def pairwise_scores(c, E, M):
+    """
+    Reference scorer mirroring Model.get_probas: the context is repeated for
+    every candidate and scored with a batched dot product.
+    """
+    C = np.repeat(np.atleast_2d(c), len(E), axis=0)
+    return np.einsum('ij,ij->i', C, E.dot(M.T))
+
+def benchmark(index, C, k=10, n_probe=8, E=None):
+    """
+    Times pairwise scoring, exact search and partitioned search for the
+    contexts in C, and reports how many exact top-k hits partitioned search
+    recovers.
+    """
+    results = {}
+    if E is not None and index.ntn_params is None:
+        start_time = time.time()
+        for c in C:
+            top_k(pairwise_scores(c, E, index.M)[None, :], k)
+        results['pairwise'] = (time.time() - start_time) / len(C)
+
+    start_time = time.time()
+    exact, _ = index.search(C, k, mode='exact')
+    results['exact'] = (time.time() - start_time) / len(C)
+
+    if index.ntn_params is None:
+        if index.centroids is None:
+            start_time = time.time()
+            index.build_partitions()
+            results['build_partitions'] = time.time() - start_time
+        start_time = time.time()
+        partitioned, _ = index.search(C, k, mode='partitioned', n_probe=n_probe)
+        results['partitioned'] = (time.time() - start_time) / len(C)
+        results['partitioned_recall@%d' % k] = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, partitioned)])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_fname', type=str, default='model.pkl', help='Model saved by main.py --save_model (needs main.py importable)')
+    parser.add_argument('--dataset_fname', type=str, default='dataset.pkl', help='Dataset filename')
+    parser.add_argument('--index_prefix', type=str, default='response_index', help='Prefix of the saved index files')
+    parser.add_argument('--quantize', action='store_true', help='Store the pool as int8')
+    parser.add_argument('--pool_size', type=int, default=0, help='Num test responses in the pool (0 for all)')
+    parser.add_argument('--n_queries', type=int, default=100, help='Num test contexts to benchmark')
+    parser.add_argument('--k', type=int, default=10, help='Num responses to retrieve')
+    parser.add_argument('--n_probe', type=int, default=8, help='Num partitions probed in partitioned mode')
+    args = parser.parse_args()
+
+    model = cPickle.load(open(args.model_fname, 'rb'))
+    _, _, test_data = cPickle.load(open(args.dataset_fname, 'rb'))
+    responses = test_data['r'][:args.pool_size] if args.pool_size > 0 else test_data['r']
+    start_time = time.time()
+    index = ResponseIndex.from_model(model, responses, quantize=args.quantize)
+    print 'encoded %d responses, took: %d(s)' % (len(index), time.time() - start_time)
+    if index.ntn_params is None:
+        # saved with the index, so built before saving
+        start_time = time.time()
+        index.build_partitions()
+        print 'built %d partitions, took: %d(s)' % (len(index.lists), time.time() - start_time)
+    index.save(args.index_prefix)
+
+    C = model.compute_encodings(test_data['c'][:10*args.n_queries:10], 'c')
+    E = model.compute_encodings(responses, 'r')
+    for key, value in sorted(benchmark(index, C, args.k, args.n_probe, E=E).iteritems()):
+        print '%s: %f' % (key, value)
+
+if __name__ == '__main__':
+    main()
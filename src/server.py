@@ -0,0 +1,246 @@
+from __future__ import division
+import argparse
+import BaseHTTPServer
+import cPickle
+import collections
+import json
+import numpy as np
+import os
+import Queue
+import SocketServer
+import threading
+import time
+import traceback
+from index_cache import IndexCache, UNK_TOKEN
+
+def to_indices(sent, cache, lock):
+    with lock:
+        indices = cache(sent)
+    return indices or [cache.unk_idx]
+
+class ModelScorer:
+    """
+    Scores with a trained Theano Model. Its compiled encoders take exactly
+    batch_size sequences, so Model.compute_encodings splits the input into
+    batch_size chunks and zero-pads the last one; the scorer itself accepts
+    encodings of any batch size.
+    """
+    def __init__(self, model):
+        self.model = model
+        if model.eval_fns is None:
+            model.compile_eval_fns()
+
+    def encode(self, seqs, key):
+        return self.model.compute_encodings(seqs, key)
+
+    def score(self, e_context, e_response):
+        return self.model.eval_fns['score'](e_context, e_response)
+
+class EngineScorer:
+    """
+    Scores with a numpy_inference.InferenceEngine, which takes any batch size.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def encode(self, seqs, key):
+        return self.engine.encode(seqs, key)
+
+    def score(self, e_context, e_response):
+        return self.engine.score(e_context, e_response)
+
+class Stats:
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.n_requests = 0
+        self.n_candidates = 0
+        self.start_time = time.time()
+
+    def add_batch(self, batch, end_time):
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            for req in batch:
+                self.latencies.append(end_time - req.arrival)
+                self.n_requests += 1
+                self.n_candidates += len(req.candidates)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            elapsed = time.time() - self.start_time
+            res = {
+                'n_requests': self.n_requests,
+                'n_candidates': self.n_candidates,
+                'requests_per_s': self.n_requests / elapsed,
+                'candidates_per_s': self.n_candidates / elapsed,
+                'mean_batch_requests': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.
+            }
+            if len(latencies) > 0:
+                res['p50_ms'] = float(np.percentile(latencies, 50))
+                res['p99_ms'] = float(np.percentile(latencies, 99))
+            return res
+
+class Request:
+    def __init__(self, context, candidates):
+        self.context = context
+        self.candidates = candidates
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+class MicroBatcher(threading.Thread):
+    """
+    Coalesces queued requests into one micro-batch until it holds
+    max_candidates candidates or the oldest request has waited max_latency
+    seconds, then encodes each context once and all candidates together.
+    """
+    def __init__(self, scorer, max_candidates=512, max_latency=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scorer = scorer
+        self.max_candidates = max_candidates
+        self.max_latency = max_latency
+        self.queue = Queue.Queue()
+        self.stats = Stats()
+
+    def submit(self, context, candidates):
+        req = Request(context, candidates)
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.scores
+
+    def run(self):
+        while True:
+            req = self.queue.get()
+            batch = [req]
+            n_candidates = len(req.candidates)
+            deadline = req.arrival + self.max_latency
+            while n_candidates < self.max_candidates:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                batch.append(req)
+                n_candidates += len(req.candidates)
+            self.process(batch)
+
+    def process(self, batch):
+        try:
+            e_c = self.scorer.encode([req.context for req in batch], 'c')
+            e_r = self.scorer.encode([r for req in batch for r in req.candidates], 'r')
+            group_ids = np.repeat(np.arange(len(batch)), [len(req.candidates) for req in batch])
+            scores = self.scorer.score(e_c[group_ids], e_r)
+            offset = 0
+            for req in batch:
+                req.scores = scores[offset:offset+len(req.candidates)]
+                offset += len(req.candidates)
+        except Exception as e:
+            for req in batch:
+                req.error = e
+        self.stats.add_batch(batch, time.time())
+        for req in batch:
+            req.done.set()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /rank with {"context": str, "candidates": [str, ...]} returns the
+    candidate scores and their ranking; GET /stats returns latency and
+    throughput figures.
+    """
+    def send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = self.server.batcher.stats.summary()
+            stats['cache_hit_rate'] = self.server.cache.hit_rate()
+            self.send_json(200, stats)
+        else:
+            self.send_json(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        if self.path != '/rank':
+            self.send_json(404, { 'error': 'not found' })
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+            if not (isinstance(req, dict) and isinstance(req.get('context'), basestring) and
+                    isinstance(req.get('candidates'), list) and all(isinstance(r, basestring) for r in req['candidates'])):
+                raise ValueError('expected {"context": str, "candidates": [str, ...]}')
+            cache, lock = self.server.cache, self.server.cache_lock
+            context = to_indices(req['context'], cache, lock)
+            candidates = [to_indices(r, cache, lock) for r in req['candidates']]
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, { 'error': str(e) })
+            return
+        if not candidates:
+            self.send_json(200, { 'scores': [], 'ranking': [] })
+            return
+        try:
+            scores = self.server.batcher.submit(context, candidates)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, { 'error': '%s: %s' % (type(e).__name__, e) })
+            return
+        self.send_json(200, { 'scores': scores.tolist(), 'ranking': np.argsort(-scores).tolist() })
+
+    def log_message(self, format, *args):
+        pass
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(batcher, word_idx_map, port=8000, unix_socket='', cache_size=100000):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, Handler)
+    else:
+        server = HTTPServer(('127.0.0.1', port), Handler)
+    server.batcher = batcher
+    server.cache = IndexCache(word_idx_map, UNK_TOKEN, maxsize=cache_size)
+    server.cache_lock = threading.Lock()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params_fname', type=str, default='', help='Parameters exported by main.py --export_fname (preferred: no Theano needed)')
+    parser.add_argument('--model_fname', type=str, default='model.pkl', help='Model saved by main.py --save_model, used if --params_fname is not given (needs main.py importable)')
+    parser.add_argument('--W_fname', type=str, default='W.pkl', help='W filename, for the word index map')
+    parser.add_argument('--port', type=int, default=8000, help='TCP port')
+    parser.add_argument('--unix_socket', type=str, default='', help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_candidates', type=int, default=512, help='Max candidates per micro-batch')
+    parser.add_argument('--cache_size', type=int, default=100000, help='Max utterances in the tokenization cache')
+    parser.add_argument('--max_latency_ms', type=float, default=5, help='Max time a request waits for its micro-batch to fill')
+    args = parser.parse_args()
+
+    _, word_idx_map = cPickle.load(open(args.W_fname, 'rb'))
+    if args.params_fname:
+        from numpy_inference import InferenceEngine
+        scorer = EngineScorer(InferenceEngine(args.params_fname))
+    else:
+        scorer = ModelScorer(cPickle.load(open(args.model_fname, 'rb')))
+    batcher = MicroBatcher(scorer, args.max_candidates, args.max_latency_ms / 1000.)
+    batcher.start()
+    server = make_server(batcher, word_idx_map, args.port, args.unix_socket, args.cache_size)
+    print 'serving on %s' % (args.unix_socket or 'port %d' % args.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
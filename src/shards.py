@@ -0,0 +1,202 @@
+"""
+Append-only dataset shards on top of a packed dataset directory.
+
+A shard store is a directory written by packed_data.py (splits, W.npy and
+word_idx_map.pkl) plus a manifest.json listing the shards ingested since.
+Every shard lives in its own subdirectory and holds the packed rows of one
+CSV file, the words it added to the vocabulary and their W rows. Nothing
+already written is modified; the manifest is replaced atomically last, so an
+interrupted ingestion leaves the store as it was.
+"""
+import argparse
+import cPickle
+import csv
+import json
+import numpy as np
+import os
+import shutil
+import packed_data
+from collections import Counter
+from index_cache import UNK_TOKEN, oov_bucket_ids, word_index
+from twokenize import tokenize
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+def read_manifest(store_dir):
+    fname = '%s/manifest.json' % store_dir
+    if not os.path.exists(fname):
+        return { 'shards': [] }
+    return json.load(open(fname))
+
+def write_manifest(store_dir, manifest):
+    tmp_fname = '%s/manifest.json.tmp' % store_dir
+    with open(tmp_fname, 'wb') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_fname, '%s/manifest.json' % store_dir)
+
+def load_word_idx_map(store_dir, manifest=None):
+    """
+    Base word_idx_map extended with the words added by every shard.
+    """
+    manifest = manifest or read_manifest(store_dir)
+    word_idx_map = cPickle.load(open('%s/word_idx_map.pkl' % store_dir, 'rb'))
+    for shard in manifest['shards']:
+        words = cPickle.load(open('%s/%s/words.pkl' % (store_dir, shard['dir']), 'rb'))
+        for i, w in enumerate(words):
+            word_idx_map[w] = shard['first_word_id'] + i
+    return word_idx_map
+
+def load_W(store_dir, manifest=None):
+    """
+    Base W with the rows added by every shard appended.
+    """
+    manifest = manifest or read_manifest(store_dir)
+    W = np.load('%s/W.npy' % store_dir, mmap_mode='r')
+    added = [np.load('%s/%s/W_new.npy' % (store_dir, s['dir'])) for s in manifest['shards'] if s['n_new_words'] > 0]
+    if not added:
+        return W
+    return np.concatenate([W] + [a.astype(W.dtype) for a in added])
+
+def load_shard_sequences(shard_dir, key, mmap_mode='r'):
+    seqs = packed_data.PackedSequences(np.load('%s/%s_tokens.npy' % (shard_dir, key), mmap_mode=mmap_mode),
+                                       np.load('%s/%s_offsets.npy' % (shard_dir, key), mmap_mode=mmap_mode))
+    ids_fname = '%s/%s_ids.npy' % (shard_dir, key)
+    if os.path.exists(ids_fname):
+        return packed_data.GroupedSequences(seqs, np.load(ids_fname, mmap_mode=mmap_mode))
+    return seqs
+
+def concat_grouped(parts):
+    """
+    GroupedSequences over parts one after the other, so that grouped splits
+    keep each context stored and encoded once. Parts that are not grouped
+    count as one sequence per row.
+    """
+    seqs, ids, n = [], [], 0
+    for p in parts:
+        if isinstance(p, packed_data.GroupedSequences):
+            seqs.append(p.seqs)
+            ids.append(np.asarray(p.ids, dtype=np.int64) + n)
+        else:
+            seqs.append(p)
+            ids.append(np.arange(n, n+len(p), dtype=np.int64))
+        n += len(seqs[-1])
+    return packed_data.GroupedSequences(packed_data.ConcatSequences(seqs), np.concatenate(ids))
+
+def load_shards(store_dir, mmap_mode='r'):
+    """
+    [train, val, test] of the base packed dataset, each extended with the
+    rows of the shards ingested into that split. Contexts of grouped splits
+    stay grouped.
+    """
+    manifest = read_manifest(store_dir)
+    datasets = packed_data.load_packed(store_dir, mmap_mode)
+    for split, dataset in zip(packed_data.SPLITS, datasets):
+        shard_dirs = ['%s/%s' % (store_dir, s['dir']) for s in manifest['shards'] if s['split'] == split]
+        if not shard_dirs:
+            continue
+        for key in ['c', 'r']:
+            parts = [dataset[key]] + [load_shard_sequences(d, key, mmap_mode) for d in shard_dirs]
+            if any(isinstance(p, packed_data.GroupedSequences) for p in parts):
+                dataset[key] = concat_grouped(parts)
+            else:
+                dataset[key] = packed_data.ConcatSequences(parts)
+        dataset['y'] = np.concatenate([dataset['y']] + [np.load('%s/y.npy' % d) for d in shard_dirs])
+    return datasets
+
+def read_csv(fname):
+    rows = []
+    for line in csv.reader(open(fname, 'rb')):
+        rows.append((tokenize(line[0]), tokenize(line[1]), int(line[2])))
+    return rows
+
+def ingest(store_dir, csv_fname, split='train', min_df=1, add_words=None, group_size=10, seed=42):
+    """
+    Tokenizes csv_fname and indexes it against the store's vocabulary as a new
+    shard. If add_words, words unknown to the store that occur in at least
+    min_df rows get new ids and random W rows, as merge_data.add_unknown_words
+    does. Other unknown words map to their hashed OOV bucket if the store has
+    buckets, or to the unknown token otherwise. add_words defaults to True
+    only for stores without buckets. If the store groups the contexts of
+    split (val and test), the shard must hold whole groups of group_size
+    rows, and its contexts are stored once each too. Returns the new
+    manifest entry.
+    """
+    manifest = read_manifest(store_dir)
+    word_idx_map = load_word_idx_map(store_dir, manifest)
+    W = np.load('%s/W.npy' % store_dir, mmap_mode='r')
+    vocab_size = W.shape[0] + sum(s['n_new_words'] for s in manifest['shards'])
+    assert vocab_size == max(word_idx_map.itervalues()) + 1, 'word_idx_map does not match the rows of W'
+    bucket_ids = oov_bucket_ids(word_idx_map)
+    if add_words is None:
+        add_words = not bucket_ids
+
+    rows = read_csv(csv_fname)
+    grouped = os.path.exists('%s/%s_c_ids.npy' % (store_dir, split))
+    if grouped and len(rows) % group_size != 0:
+        raise ValueError('%s: %d rows do not make whole groups of %d for the %s split' % (csv_fname, len(rows), group_size, split))
+    new_words = []
+    if add_words:
+        df = Counter()
+        for c, r, _ in rows:
+            df.update(w for w in set(c) | set(r) if w not in word_idx_map)
+        new_words = sorted(w for w, n in df.iteritems() if n >= min_df)
+
+    shard = {
+        'dir': 'shard_%05d' % len(manifest['shards']),
+        'source': os.path.abspath(csv_fname),
+        'split': split,
+        'n_rows': len(rows),
+        'first_word_id': vocab_size,
+        'n_new_words': len(new_words)
+    }
+    shard_dir = '%s/%s' % (store_dir, shard['dir'])
+    if os.path.exists(shard_dir):
+        # left over from an interrupted ingestion
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+
+    for i, w in enumerate(new_words):
+        word_idx_map[w] = vocab_size + i
+    rng = np.random.RandomState(seed + len(manifest['shards']))
+    np.save('%s/W_new.npy' % shard_dir, rng.uniform(-0.25, 0.25, (len(new_words), W.shape[1])).astype(W.dtype))
+    cPickle.dump(new_words, open('%s/words.pkl' % shard_dir, 'wb'), protocol=-1)
+
+    unk_idx = word_idx_map[UNK_TOKEN]
+    dtype = packed_data.token_dtype(vocab_size + len(new_words))
+    for j, key in enumerate(['c', 'r']):
+        seqs = [[word_index(w, word_idx_map, unk_idx, bucket_ids) for w in row[j]] for row in rows]
+        if grouped and key == 'c':
+            seqs, ids = packed_data.dedup_sequences(seqs)
+            np.save('%s/c_ids.npy' % shard_dir, ids)
+        tokens, offsets = packed_data.pack_sequences(seqs, dtype)
+        np.save('%s/%s_tokens.npy' % (shard_dir, key), tokens)
+        np.save('%s/%s_offsets.npy' % (shard_dir, key), offsets)
+    np.save('%s/y.npy' % shard_dir, np.array([row[2] for row in rows], dtype=np.int32))
+
+    manifest['shards'].append(shard)
+    manifest['vocab_size'] = vocab_size + len(new_words)
+    write_manifest(store_dir, manifest)
+    return shard
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store_dir', help='Directory written by packed_data.py')
+    parser.add_argument('csv_fnames', nargs='*', help='context,response,label CSV files to ingest, one shard each')
+    parser.add_argument('--split', type=str, default='train', help='Split the new rows belong to')
+    parser.add_argument('--min_df', type=int, default=1, help='Min num rows a new word must occur in to get its own id')
+    parser.add_argument('--add_words', type=str, default='auto', help='Give unknown words their own ids: true, false or auto (only if the store has no OOV buckets)')
+    args = parser.parse_args()
+
+    add_words = None if args.add_words == 'auto' else str2bool(args.add_words)
+    for fname in args.csv_fnames:
+        shard = ingest(args.store_dir, fname, args.split, args.min_df, add_words)
+        print '%s: %d rows, %d new words -> %s' % (fname, shard['n_rows'], shard['n_new_words'], shard['dir'])
+    manifest = read_manifest(args.store_dir)
+    print 'shards: %d, vocab size: %d' % (len(manifest['shards']), manifest.get('vocab_size', 0))
+    for split in packed_data.SPLITS:
+        n = sum(s['n_rows'] for s in manifest['shards'] if s['split'] == split)
+        print '%s: %d shard rows' % (split, n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+from __future__ import division
+import argparse
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import subprocess
+import sys
+import threading
+import time
+from distutils.spawn import find_executable
+from process_results import summarize
+
+def grid_trials(spec):
+    """
+    {"grid": {"hidden_size": [50, 200], "lr": [0.001, 0.0005]}} expands to
+    every combination.
+    """
+    keys = sorted(spec['grid'])
+    return [dict(zip(keys, values)) for values in itertools.product(*[spec['grid'][k] for k in keys])]
+
+def random_trials(spec, seed=42):
+    """
+    {"random": {"lr": {"log_uniform": [1e-4, 1e-2]}, "hidden_size": {"choice": [50, 100]}},
+     "n_trials": 20} draws n_trials independent settings.
+    """
+    rng = np.random.RandomState(seed)
+    trials = []
+    for _ in xrange(spec['n_trials']):
+        trial = {}
+        for key, dist in sorted(spec['random'].iteritems()):
+            if 'choice' in dist:
+                trial[key] = dist['choice'][rng.randint(len(dist['choice']))]
+            elif 'uniform' in dist:
+                trial[key] = float(rng.uniform(*dist['uniform']))
+            elif 'log_uniform' in dist:
+                lo, hi = np.log(dist['log_uniform'])
+                trial[key] = float(np.exp(rng.uniform(lo, hi)))
+            elif 'int_uniform' in dist:
+                trial[key] = int(rng.randint(dist['int_uniform'][0], dist['int_uniform'][1]+1))
+            else:
+                raise ValueError('Unsupported distribution for %s: %s' % (key, dist))
+        trials.append(trial)
+    return trials
+
+def make_trials(spec, seed=42):
+    trials = grid_trials(spec) if 'grid' in spec else random_trials(spec, seed)
+    fixed = spec.get('fixed', {})
+    return [dict(fixed, **trial) for trial in trials]
+
+class Sweep:
+    """
+    Runs main.py trials n_concurrent at a time, each pinned to its own CPUs
+    with as many BLAS/OpenMP threads. Trials load the same packed dataset
+    directory, whose memory-mapped arrays are shared through the page cache.
+    A trial is stopped early when its best val recall@1 after some epoch is
+    more than margin below the best any trial had reached by that epoch.
+    base_args are passed to every trial that does not set them itself.
+    """
+    def __init__(self, trials, out_dir, n_concurrent, threads_per_trial, metric='val_r1@10',
+                 margin=0.02, min_epochs=1, poll_interval=5., base_args=None):
+        self.trials = trials
+        self.base_args = base_args or {}
+        self.out_dir = out_dir
+        self.n_concurrent = n_concurrent
+        self.threads_per_trial = threads_per_trial
+        self.metric = metric
+        self.margin = margin
+        self.min_epochs = min_epochs
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.best_by_epoch = {}
+        self.free_slots = range(n_concurrent)
+        self.stopped = set()
+
+    def command(self, i, trial, slot):
+        cmd = [sys.executable, 'main.py'] + ['--%s=%s' % (k, v) for k, v in sorted(dict(self.base_args, **trial).iteritems())]
+        cmd += ['--metrics_fname=%s' % self.metrics_fname(i)]
+        if find_executable('taskset'):
+            cpus = range(slot*self.threads_per_trial, (slot+1)*self.threads_per_trial)
+            cmd = ['taskset', '-c', ','.join(map(str, cpus))] + cmd
+        return cmd
+
+    def metrics_fname(self, i):
+        return '%s/trial_%d.jsonl' % (self.out_dir, i)
+
+    def read_records(self, i):
+        try:
+            with open(self.metrics_fname(i)) as f:
+                return [json.loads(l) for l in f if l.strip()]
+        except (IOError, ValueError):
+            return []
+
+    def should_stop(self, i):
+        """
+        Updates the best metric seen at each epoch with trial i's progress and
+        tells whether trial i has fallen behind.
+        """
+        best = 0.
+        behind = False
+        with self.lock:
+            for record in self.read_records(i):
+                if record.get('event') != 'epoch' or self.metric not in record:
+                    continue
+                epoch = record['epoch']
+                best = max(best, record[self.metric])
+                leader = self.best_by_epoch.get(epoch, 0.)
+                self.best_by_epoch[epoch] = max(leader, best)
+                behind = epoch >= self.min_epochs and best < leader - self.margin
+        return behind
+
+    def run_trial(self, i):
+        trial = self.trials[i]
+        with self.lock:
+            slot = self.free_slots.pop()
+        env = dict(os.environ)
+        for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            env[var] = str(self.threads_per_trial)
+        log = open('%s/trial_%d.log' % (self.out_dir, i), 'wb')
+        # main.py appends to its metrics file; start from an empty one so a
+        # rerun into the same out_dir does not mix in an earlier trial
+        open(self.metrics_fname(i), 'wb').close()
+        p = subprocess.Popen(self.command(i, trial, slot), stdout=log, stderr=subprocess.STDOUT, env=env)
+        while p.poll() is None:
+            time.sleep(self.poll_interval)
+            if self.should_stop(i):
+                p.terminate()
+                p.wait()
+                with self.lock:
+                    self.stopped.add(i)
+                print 'trial %d stopped early' % i
+        self.should_stop(i)
+        log.close()
+        with self.lock:
+            self.free_slots.append(slot)
+        print 'trial %d done: %s' % (i, trial)
+
+    def run(self):
+        pending = range(len(self.trials))
+        threads = []
+        while pending or threads:
+            threads = [t for t in threads if t.is_alive()]
+            while pending and len(threads) < self.n_concurrent:
+                t = threading.Thread(target=self.run_trial, args=(pending.pop(0),))
+                t.start()
+                threads.append(t)
+            time.sleep(0.1)
+
+    def results(self):
+        rows = []
+        for i, trial in enumerate(self.trials):
+            records = self.read_records(i)
+            summary = summarize(self.metrics_fname(i), records) if records else None
+            row = dict(trial)
+            row['trial'] = i
+            row['stopped_early'] = i in self.stopped
+            if summary is not None:
+                row.update((k, v) for k, v in summary.iteritems() if k not in ['args', 'fname'])
+            rows.append(row)
+        rows.sort(key=lambda r: r.get(self.metric, -1), reverse=True)
+        return rows
+
+def write_table(rows, fname, columns):
+    with open(fname, 'wb') as f:
+        f.write('\t'.join(columns) + '\n')
+        for r in rows:
+            f.write('\t'.join(str(r.get(c, '-')) for c in columns) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spec_fname', help='JSON sweep spec with "grid" or "random" (+ "n_trials"), and optional "fixed" args')
+    parser.add_argument('--out_dir', type=str, default='sweep', help='Directory for trial logs and results')
+    parser.add_argument('--n_concurrent', type=int, default=4, help='Num trials running at once')
+    parser.add_argument('--threads_per_trial', type=int, default=0, help='CPU threads per trial (default: cpus / n_concurrent)')
+    parser.add_argument('--metric', type=str, default='val_r1@10', help='Metric used for early stopping and ranking')
+    parser.add_argument('--margin', type=float, default=0.02, help='Stop trials this far behind the best at the same epoch')
+    parser.add_argument('--min_epochs', type=int, default=1, help='Never stop a trial before this many epochs')
+    parser.add_argument('--seed', type=int, default=42, help='Random search seed')
+    parser.add_argument('--dataset_fname', type=str, default='dataset_packed', help='Dataset of trials that do not set one (default: the packed_data.py directory, shared through the page cache)')
+    parser.add_argument('--W_fname', type=str, default='', help='W of trials that do not set one (default: <dataset_fname>/W.npy)')
+    args = parser.parse_args()
+
+    spec = json.load(open(args.spec_fname))
+    trials = make_trials(spec, args.seed)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    threads_per_trial = args.threads_per_trial or max(1, multiprocessing.cpu_count() // args.n_concurrent)
+    print 'running %d trials, %d at a time, %d threads each' % (len(trials), args.n_concurrent, threads_per_trial)
+
+    base_args = { 'dataset_fname': args.dataset_fname, 'W_fname': args.W_fname or '%s/W.npy' % args.dataset_fname }
+    sweep = Sweep(trials, args.out_dir, args.n_concurrent, threads_per_trial, args.metric, args.margin, args.min_epochs,
+                  base_args=base_args)
+    sweep.run()
+    rows = sweep.results()
+    keys = sorted(set(k for trial in trials for k in trial))
+    columns = ['trial'] + keys + [args.metric, 'test_r1@10', 'test_r2@10', 'test_r5@10', 'n_epochs', 'stopped_early']
+    write_table(rows, '%s/results.tsv' % args.out_dir, columns)
+    for r in rows:
+        print '\t'.join(str(r.get(c, '-')) for c in columns)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,9 @@
 from __future__ import division
 import csv
 import numpy as np
-import random
-import scipy
 from scipy.spatial.distance import cosine
-from sklearn.feature_extraction.text import *
-from sklearn.metrics import *
-from sklearn.preprocessing import *
-from sklearn.svm import *
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import classification_report
 
 TRAIN_FILES = ['../data/trainset%s.csv' % s for s in ['_full']]
 VAL_FILE = '../data/valset.csv'
@@ -59,17 +55,21 @@ def load_data(fname):
         Y.append(int(line[2]))
     return C, R, Y
 
-val_C, val_R, val_Y = load_data(VAL_FILE)
-test_C, test_R, test_Y = load_data(TEST_FILE)
-for train_file in TRAIN_FILES:
-    print train_file
-    train_C, train_R, train_Y = load_data(train_file)
-    vectorizer = TfidfVectorizer()
-    vectorizer.fit(train_C+train_R+val_C+val_R)
-    C_vec = vectorizer.transform(test_C)
-    R_vec = vectorizer.transform(test_R)
-    Y = np.array(test_Y)
+def main():
+    val_C, val_R, val_Y = load_data(VAL_FILE)
+    test_C, test_R, test_Y = load_data(TEST_FILE)
+    for train_file in TRAIN_FILES:
+        print train_file
+        train_C, train_R, train_Y = load_data(train_file)
+        vectorizer = TfidfVectorizer()
+        vectorizer.fit(train_C+train_R+val_C+val_R)
+        C_vec = vectorizer.transform(test_C)
+        R_vec = vectorizer.transform(test_R)
+        Y = np.array(test_Y)
     
-    for group_size in [2, 10]:
-        print train_file, group_size
-        run(C_vec, R_vec, Y, group_size)
+        for group_size in [2, 10]:
+            print train_file, group_size
+            run(C_vec, R_vec, Y, group_size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+
+STRATEGIES = ['head', 'tail', 'turns', 'turn_cap']
+EOT_TOKENS = ['__eot__', '__EOS__']
+
+def find_eot_ids(word_idx_map):
+    """
+    Ids of the end-of-turn / end-of-utterance tokens present in word_idx_map.
+    """
+    return [word_idx_map[w] for w in EOT_TOKENS if w in word_idx_map]
+
+def split_turns(row, eot_ids):
+    """
+    Splits a sequence into turns, each ending with its delimiter (the last
+    turn may have none).
+    """
+    row = np.asarray(row)
+    ends = np.flatnonzero(np.in1d(row, eot_ids)) + 1
+    bounds = np.concatenate([[0], ends[ends < len(row)], [len(row)]])
+    return [row[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+def truncate(row, max_l, strategy='head', eot_ids=(), max_turns=0, max_turn_len=0):
+    """
+    Shortens a context to at most max_l tokens.
+      head:     first max_l tokens (the original behaviour)
+      tail:     last max_l tokens, i.e. the turns closest to the response
+      turns:    last max_turns turns, then the last max_l tokens of those
+      turn_cap: last max_turn_len tokens of every turn, then the last max_l
+    """
+    if strategy == 'head':
+        return row[:max_l]
+    if strategy in ['turns', 'turn_cap']:
+        if len(eot_ids) == 0:
+            raise ValueError('truncation strategy %s needs end-of-turn token ids' % strategy)
+        turns = split_turns(row, eot_ids)
+        if strategy == 'turns' and max_turns > 0:
+            turns = turns[-max_turns:]
+        elif strategy == 'turn_cap' and max_turn_len > 0:
+            turns = [t[-max_turn_len:] for t in turns]
+        row = np.concatenate(turns) if turns else np.asarray(row)[:0]
+    elif strategy != 'tail':
+        raise ValueError('Unsupported truncation strategy: %s' % strategy)
+    return row[-max_l:] if len(row) > max_l else row
@@ -0,0 +1,67 @@
+"""
+Single entry point with subcommands:
+
+  python ubottu.py train [main.py args]
+  python ubottu.py eval --probas_fname test_probas.pkl
+  python ubottu.py report [generate_report.py args]
+  python ubottu.py tfidf
+
+Each subcommand imports its dependencies only when it runs, so eval and
+report start without loading Theano, Lasagne or scikit-learn.
+"""
+import sys
+
+def run_script_main(name, module_main, argv):
+    sys.argv = ['%s %s' % (sys.argv[0], name)] + argv
+    module_main()
+
+def train(argv):
+    import main
+    run_script_main('train', main.main, argv)
+
+def report(argv):
+    import generate_report
+    run_script_main('report', generate_report.main, argv)
+
+def tfidf(argv):
+    import tfidf
+    run_script_main('tfidf', tfidf.main, argv)
+
+def load_probas(fname):
+    import numpy as np
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r')
+    import cPickle
+    return np.asarray(cPickle.load(open(fname, 'rb')))
+
+def evaluate(argv):
+    """
+    Recall@k of saved test probabilities, as reported by Model.train.
+    """
+    import argparse
+    import json
+    from common import compute_recall_ks, flatten_recall_ks
+    parser = argparse.ArgumentParser(prog='%s eval' % sys.argv[0])
+    parser.add_argument('--probas_fname', type=str, default='test_probas.pkl', help='Pickled or .npy probabilities, in groups of 10')
+    parser.add_argument('--prefix', type=str, default='test', help='Metric name prefix')
+    args = parser.parse_args(argv)
+
+    probas = load_probas(args.probas_fname)
+    metrics = flatten_recall_ks(compute_recall_ks(probas), args.prefix)
+    print 'metrics: %s' % json.dumps(dict(metrics, event='eval', fname=args.probas_fname), sort_keys=True)
+
+COMMANDS = {
+    'train': train,
+    'eval': evaluate,
+    'report': report,
+    'tfidf': tfidf
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print __doc__.strip()
+        sys.exit(1)
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ parser.register('type','bool',str2bool)
 parser.add_argument('--fname', type=str, default='trainset.csv', help='Input file name')
 parser.add_argument('--run_w2v', type='bool', default=True, help='Run word2vec')
 parser.add_argument('--dump_W', type='bool', default=True, help='Dump embeddings')
+parser.add_argument('--W_format', type=str, default='pkl', help='Format of dumped embeddings: pkl or npy (memory-mappable)')
 parser.add_argument('--window_size', type=int, default=7, help='Window size')
 parser.add_argument('--embedding_size', type=int, default=300, help='Embedding size')
 parser.add_argument('--min_count', type=int, default=1, help='Min count')
@@ -69,17 +70,42 @@ if args.run_w2v:
     model.train(lines)
     cPickle.dump(model, open('w2v_model_ws%s_d%d.pkl' % (args.window_size, args.embedding_size), 'wb'), protocol=-1)
 
+def gather_W(model, word_idx_map, nrows, ndims, out=None):
+    """
+    Copies the vectors of all words known to model into W in one fancy-index
+    assignment; rows for words missing from model get uniform random vectors.
+    """
+    dst, src = [], []
+    for word, idx in word_idx_map.iteritems():
+        v = model.vocab.get(word)
+        if v is not None:
+            dst.append(idx)
+            src.append(v.index)
+    dst = np.array(dst, dtype=np.int64)
+    src = np.array(src, dtype=np.int64)
+
+    W = np.empty((nrows, ndims), dtype=np.float32) if out is None else out
+    missing = np.ones(nrows, dtype=bool)
+    missing[dst] = False
+    W[missing] = np.random.uniform(-0.25, 0.25, (missing.sum(), ndims)).astype(np.float32)
+    W[dst] = model.syn0[src]
+    return W, len(word_idx_map) - len(dst)
+
 if args.dump_W:
     model = cPickle.load(open('w2v_model_ws%s_d%s.pkl' % (args.window_size, args.embedding_size)))
     orig_W, word_idx_map = cPickle.load(open('dataset_1000000_updated/W.pkl'))
-    W = np.random.uniform(-0.25, 0.25, (orig_W.shape[0], args.embedding_size)).astype(np.float32)
-    num_skipped = 0
-    for word in sorted(word_idx_map, key=word_idx_map.get, reverse=False):
-        idx = word_idx_map[word]
-        if not word in model:
-            num_skipped += 1
-            continue
-        embedding = model[word]
-        W[idx, :] = embedding
-    cPickle.dump([W, word_idx_map], open('custom_ws%s_d%s_W.pkl' % (args.window_size, args.embedding_size), 'wb'), protocol=-1)
+    nrows = orig_W.shape[0]
+    del orig_W
+    fname = 'custom_ws%s_d%s_W' % (args.window_size, args.embedding_size)
+    if args.W_format == 'npy':
+        # W goes to a .npy that main.py can open with mmap_mode='r'; the word
+        # index map is pickled next to it, where common.load_word_idx_map
+        # looks for it (<name>_word_idx_map.pkl for <name>.npy).
+        W = np.lib.format.open_memmap('%s.npy' % fname, mode='w+', dtype=np.float32, shape=(nrows, args.embedding_size))
+        W, num_skipped = gather_W(model, word_idx_map, nrows, args.embedding_size, out=W)
+        W.flush()
+        cPickle.dump(word_idx_map, open('%s_word_idx_map.pkl' % fname, 'wb'), protocol=-1)
+    else:
+        W, num_skipped = gather_W(model, word_idx_map, nrows, args.embedding_size)
+        cPickle.dump([W, word_idx_map], open('%s.pkl' % fname, 'wb'), protocol=-1)
     print 'skipped: ', num_skipped, 'total: ', len(word_idx_map)